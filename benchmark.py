@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+"""Offline benchmark of the migration.
+
+Generates a synthetic wiki corpus, serves it from local stand-ins for the
+redmine and Confluence REST APIs, and measures the pure
+conversion functions and the full main() pipeline against them.
+"""
+import argparse
+import BaseHTTPServer
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+
+import logbook
+
+import redmine2confluence as r2c
+from confluence import Confluence
+from converter import ConversionPool
+from journal import Journal
+from metrics import Metrics
+from ratelimit import RateLimiter
+
+log = logbook.Logger('benchmark')
+
+PAGE_KINDS = ['deep', 'table', 'links', 'malformed', 'attachment']
+MULTIPART_FILENAME_REGEX = re.compile(r'filename="([^"]*)"')
+
+
+def generate_corpus(pages=200, projects=2, depth=8, table_rows=300,
+                    attachment_size=1024 * 1024, seed=0):
+    """Returns synthetic redmine projects, with wiki pages of every kind:
+    deep hierarchies, large tables, link-heavy pages, malformed html and
+    pages with big attachments.
+    """
+    rand = random.Random(seed)
+    corpus = {}
+    attachment_id = 0
+    for proj_idx in range(projects):
+        identifier = 'bench%d' % proj_idx
+        wiki_pages = []
+        for idx in range(pages // projects):
+            kind = PAGE_KINDS[idx % len(PAGE_KINDS)]
+            title = 'Page_%d_%s' % (idx, kind)
+            parent = None
+            if kind == 'deep' and idx >= len(PAGE_KINDS):
+                # chains of `depth` pages
+                if (idx // len(PAGE_KINDS)) % depth:
+                    parent = wiki_pages[idx - len(PAGE_KINDS)]['title']
+            elif idx:
+                parent = wiki_pages[rand.randrange(idx)]['title']
+            attachments = []
+            lines = ['h1. %s' % title.replace('_', ' '), '',
+                     'Some *bold* and _emphasised_ text about %s.' % kind, '']
+            if kind == 'table':
+                lines.append('|_. name |_. value |_. notes |')
+                for row in range(table_rows):
+                    lines.append('| row %d | %d | @code %d@ |' % (
+                        row, rand.randrange(10 ** 6), row))
+            elif kind == 'links':
+                for link in range(100):
+                    target = rand.randrange(pages // projects)
+                    lines.append(
+                        'See [[Page_%d]], [[Page_%d|that page]], issue #%d, '
+                        'http://example.com/%d and '
+                        'http://redmine/redmine/projects/bench%d/wiki/Page_%d' % (
+                            target, target, link, link,
+                            rand.randrange(projects), target))
+            elif kind == 'malformed':
+                for block in range(50):
+                    lines.append('<div class="x%d"><b>unclosed <span>tags %d '
+                                 '<br> & bare ampersands < and >' % (block, block))
+                    lines.append('<pre>x < y</p></pre>')
+                    lines.append('')
+            elif kind == 'attachment':
+                attachment_id += 1
+                filename = 'image %d.png' % attachment_id
+                attachments.append({
+                    'id': attachment_id,
+                    'filename': filename,
+                    'filesize': attachment_size,
+                    'description': 'Attachment %d' % attachment_id
+                })
+                lines.append('!%s!' % urllib.quote(filename))
+            else:
+                lines.extend('Paragraph %d of a deep page.' % p for p in range(20))
+            wiki_pages.append({
+                'title': title,
+                'parent': parent,
+                'text': '\n'.join(lines),
+                'version': 1,
+                'attachments': attachments
+            })
+        corpus[identifier] = {
+            'id': proj_idx + 1,
+            'name': 'Benchmark project %d' % proj_idx,
+            'description': 'Synthetic wiki',
+            'space': 'BENCH%d' % proj_idx,
+            'wiki_pages': wiki_pages
+        }
+    return corpus
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, latency=0.0, **state):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.__dict__.update(state)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, data, content_type='application/json'):
+        if content_type == 'application/json':
+            data = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def dispatch(self):
+        """Calls the handler of the first route (method, path regex,
+        handler) matching the request
+        """
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.latency)
+        url = urlparse.urlparse(self.path)
+        path = urllib.unquote(url.path).decode('utf8')
+        params = dict(urlparse.parse_qsl(url.query))
+        for method, pattern, handler in self.routes:
+            match = re.match(pattern + '$', path)
+            if match and method == self.command:
+                return handler(self, params, *match.groups())
+        self.respond(404, {'message': 'Not found: %s %s' % (self.command, path)})
+
+    do_GET = do_POST = do_PUT = dispatch
+
+
+class FakeRedmineHandler(StandInHandler):
+    """Serves a corpus the way the redmine REST API does"""
+    def project(self, params, identifier):
+        project = self.server.corpus.get(identifier)
+        if project is None:
+            return self.respond(404, {})
+        self.respond(200, {'project': {
+            'id': project['id'], 'identifier': identifier,
+            'name': project['name'], 'description': project['description']
+        }})
+
+    def find_project(self, project_id):
+        for project in self.server.corpus.itervalues():
+            if str(project['id']) == project_id:
+                return project
+
+    def wiki_index(self, params, project_id):
+        project = self.find_project(project_id)
+        self.respond(200, {'wiki_pages': [
+            self.wiki_page(wiki_page, full=False)
+            for wiki_page in project['wiki_pages']]})
+
+    def wiki_page(self, wiki_page, full=True):
+        retval = {
+            'title': wiki_page['title'],
+            'version': wiki_page['version'],
+            'created_on': '2015-01-01T00:00:00Z',
+            'updated_on': '2015-01-01T00:00:00Z'
+        }
+        if wiki_page['parent']:
+            retval['parent'] = {'title': wiki_page['parent']}
+        if full:
+            retval['text'] = wiki_page['text']
+            retval['author'] = {'id': 1, 'name': 'Bench User'}
+            retval['attachments'] = [dict(
+                attachment, content_url='%s/attachments/download/%d/%s' % (
+                    self.server.url, attachment['id'],
+                    urllib.quote(attachment['filename'])),
+                author={'id': 1, 'name': 'Bench User'},
+                created_on='2015-01-01T00:00:00Z')
+                for attachment in wiki_page['attachments']]
+        return retval
+
+    def wiki(self, params, project_id, title):
+        project = self.find_project(project_id)
+        for wiki_page in project['wiki_pages']:
+            if wiki_page['title'] == title:
+                return self.respond(200, {'wiki_page': self.wiki_page(wiki_page)})
+        self.respond(404, {})
+
+    def users(self, params):
+        self.respond(200, {'users': [{'id': 1, 'login': 'bench'}]})
+
+    def user(self, params, user_id):
+        self.respond(200, {'user': {'id': 1, 'login': 'bench'}})
+
+    def download(self, params, attachment_id, filename):
+        for project in self.server.corpus.itervalues():
+            for wiki_page in project['wiki_pages']:
+                for attachment in wiki_page['attachments']:
+                    if str(attachment['id']) == attachment_id:
+                        return self.respond(200, '\0' * attachment['filesize'],
+                                            'application/octet-stream')
+        self.respond(404, {})
+
+    routes = [
+        ('GET', r'/projects/(\d+)/wiki/index\.json', wiki_index),
+        ('GET', r'/projects/(\d+)/wiki/(.+)\.json', wiki),
+        ('GET', r'/projects/([^/]+)\.json', project),
+        ('GET', r'/users\.json', users),
+        ('GET', r'/users/(\d+)\.json', user),
+        ('GET', r'/attachments/download/(\d+)/(.+)', download),
+    ]
+
+
+class FakeConfluenceHandler(StandInHandler):
+    """Accepts pages and attachments the way the Confluence REST API
+    does, rejecting pages which aren't well-formed
+    """
+    def space(self, params):
+        self.read_body()
+        self.respond(200, {})
+
+    def titles(self, params):
+        self.respond(200, {'results': []})
+
+    def create_page(self, params):
+        data = json.loads(self.read_body())
+        if not r2c.is_well_formed(data['body']['storage']['value']):
+            return self.respond(400, {'message': 'Error parsing xhtml'})
+        with self.server.lock:
+            page_id = str(len(self.server.pages) + 1)
+            self.server.pages[page_id] = data
+        self.respond(200, {'id': page_id, 'title': data['title']})
+
+    def get_page(self, params, page_id):
+        page = self.server.pages.get(page_id)
+        if page is None:
+            return self.respond(404, {})
+        self.respond(200, {'id': page_id, 'title': page['title'],
+                           'version': {'number': 1}})
+
+    def update_page(self, params, page_id):
+        self.read_body()
+        self.respond(200, {'id': page_id})
+
+    def attachment(self, params, page_id):
+        match = MULTIPART_FILENAME_REGEX.search(self.read_body())
+        self.respond(200, {'results': [{'title': match and match.group(1)}]})
+
+    routes = [
+        ('POST', r'/rest/api/space', space),
+        ('GET', r'/rest/api/content', titles),
+        ('POST', r'/rest/api/content', create_page),
+        ('GET', r'/rest/api/content/(\d+)', get_page),
+        ('PUT', r'/rest/api/content/(\d+)', update_page),
+        ('POST', r'/rest/api/content/(\d+)/child/attachment', attachment),
+    ]
+
+
+def peak_rss():
+    """Peak resident memory in MB of this process and of its largest child
+    (pandoc)
+    """
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0)
+
+
+def report(name, pages, seconds, metrics, **extra):
+    self_rss, children_rss = peak_rss()
+    retval = dict(extra, **{
+        'pages': pages,
+        'seconds': seconds,
+        'pages/sec': pages / seconds if seconds else None,
+        'peak rss (MB)': self_rss,
+        'peak child rss (MB)': children_rss,
+        'stages': metrics.report().get('total', {})
+    })
+    print '%s: %d pages in %.2fs, %.1f pages/sec, peak rss %.0f MB ' \
+          '(pandoc %.0f MB)' % (name, pages, seconds, retval['pages/sec'] or 0,
+                                self_rss, children_rss)
+    for stage, entry in sorted(retval['stages'].iteritems(),
+                               key=lambda item: -item[1]['seconds']):
+        print '    %-20s %8.2fs %6d calls %12d bytes' % (
+            stage, entry['seconds'], entry['count'], entry['bytes'])
+    return retval
+
+
+def use_corpus(corpus):
+    """Maps the corpus projects to spaces, for the link conversion"""
+    r2c.PROJECTS = dict((identifier, project['space'])
+                        for identifier, project in corpus.iteritems())
+
+
+def bench_conversion(corpus):
+    """Times the pure conversion of every page"""
+    use_corpus(corpus)
+    r2c.METRICS = Metrics()
+    count = 0
+    start = time.time()
+    for identifier, project in sorted(corpus.iteritems()):
+        for wiki_page in project['wiki_pages']:
+            images = dict((attachment['filename'], attachment['filename'])
+                          for attachment in wiki_page['attachments'])
+            with r2c.METRICS.time('convert_links', len(wiki_page['text'])):
+                source = r2c.convert_links(
+                    wiki_page['text'], project['space'], identifier)
+            r2c.convert_page(source, wiki_page['title'].replace('_', ' '),
+                             images)
+            count += 1
+    return report('conversion', count, time.time() - start, r2c.METRICS)
+
+
+def bench_pipeline(corpus, latency=0.0, workers=1, prefetch=10, rate=None,
+                   processes=0):
+    """Times main() against local redmine and Confluence stand-ins"""
+    r2c.CONVERTER = None
+    if processes:
+        r2c.CONVERTER = ConversionPool(
+            processes, initializer=r2c.init_converter, initargs=(None,))
+    redmine_server = StandInServer(
+        FakeRedmineHandler, latency, corpus=corpus).start()
+    confluence_server = StandInServer(
+        FakeConfluenceHandler, latency, pages={}).start()
+    tmp = tempfile.mkdtemp()
+    try:
+        limiter = RateLimiter(rate)
+        r2c.METRICS = Metrics()
+        r2c.STATS.clear()
+        use_corpus(corpus)
+        r2c.REDMINE = {'url': redmine_server.url, 'key': 'benchmark'}
+        r2c.confluence = Confluence(confluence_server.url, 'bench', 'bench',
+                                    pool_size=max(workers, 10), limiter=limiter)
+        r2c.redmine = r2c.ThrottledRedmine(redmine_server.url, limiter,
+                                           key='benchmark')
+        r2c.users = r2c.UserCache(r2c.redmine)
+        r2c.users.prefetch()
+        r2c.journal = Journal(os.path.join(tmp, 'journal.sqlite'))
+        start = time.time()
+        r2c.main(workers=workers, prefetch=prefetch)
+        seconds = time.time() - start
+        pages = sum(len(project['wiki_pages']) for project in corpus.itervalues())
+        return report('pipeline', pages, seconds, r2c.METRICS,
+                      requests={'redmine': redmine_server.requests,
+                                'confluence': confluence_server.requests},
+                      stats=r2c.STATS)
+    finally:
+        if r2c.CONVERTER:
+            r2c.CONVERTER.close()
+        redmine_server.shutdown()
+        confluence_server.shutdown()
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the migration against local stand-in servers')
+    parser.add_argument('--pages', type=int, default=200,
+                        help='Number of wiki pages to generate')
+    parser.add_argument('--projects', type=int, default=2,
+                        help='Number of projects to spread the pages over')
+    parser.add_argument('--table-rows', type=int, default=300,
+                        help='Rows of the large tables')
+    parser.add_argument('--attachment-size', type=int, default=1024,
+                        metavar='KB', help='Size of the generated attachments')
+    parser.add_argument('--latency', type=float, default=0.0, metavar='MS',
+                        help='Latency the stand-in servers add to each request')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of pages to import concurrently')
+    parser.add_argument('--prefetch', type=int, default=10,
+                        help='Number of pages to fetch from redmine ahead')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Maximum requests per second')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='Number of processes converting pages in the '
+                             'pipeline (default: convert in-line)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the corpus generator')
+    parser.add_argument('--conversion-only', action='store_true',
+                        help="Don't benchmark the full pipeline")
+    parser.add_argument('--output', metavar='FILE',
+                        help='Also write the results to FILE as json')
+    args = parser.parse_args()
+    if args.rate is not None and args.rate <= 0:
+        parser.error('--rate must be positive')
+
+    corpus = generate_corpus(
+        args.pages, args.projects, table_rows=args.table_rows,
+        attachment_size=args.attachment_size * 1024, seed=args.seed)
+    results = {}
+    with logbook.NullHandler().applicationbound():
+        with logbook.StderrHandler(level='ERROR', bubble=False).applicationbound():
+            results['conversion'] = bench_conversion(corpus)
+            if not args.conversion_only:
+                results['pipeline'] = bench_pipeline(
+                    corpus, args.latency / 1000.0, args.workers, args.prefetch,
+                    args.rate, args.processes)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(json.dumps(results, indent=4))
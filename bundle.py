@@ -0,0 +1,88 @@
+import codecs
+from collections import namedtuple
+import json
+import os
+
+from redmine.exceptions import ResourceAttrError
+
+ExportedAttachment = namedtuple(
+    'ExportedAttachment',
+    'id filename filesize description content_url digest')
+
+
+class ExportedPage(object):
+    """A converted wiki page read back from an export bundle.
+    Has the attributes of the redmine wiki pages the import functions
+    expect, plus the converted body. The body is only read from disk by
+    load().
+    """
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self.title = meta['title']
+        self.version = meta['version']
+        self.updated_on = meta['updated_on']
+        self.attachments = [ExportedAttachment(**attachment)
+                            for attachment in meta['attachments']]
+        self.converted = None
+
+    @property
+    def parent(self):
+        if self.meta['parent'] is None:
+            raise ResourceAttrError()
+        return {'title': self.meta['parent']}
+
+    def load(self):
+        self.converted = {'nuclear': self.meta['nuclear']}
+        for key in ['body', 'source']:
+            with codecs.open(os.path.join(self.path, self.meta[key]),
+                             encoding='utf8') as f:
+                self.converted[key] = f.read()
+        return self
+
+
+class BundleWriter(object):
+    """Writes a project's converted pages, with their metadata, hierarchy and
+    attachment manifests, to a directory of an export bundle.
+    """
+    def __init__(self, path, proj_name, space, name, description):
+        self.path = os.path.join(path, proj_name)
+        if not os.path.isdir(os.path.join(self.path, 'pages')):
+            os.makedirs(os.path.join(self.path, 'pages'))
+        self.project = {
+            'project': proj_name,
+            'space': space,
+            'name': name,
+            'description': description,
+            'pages': []
+        }
+
+    def add_page(self, meta, body, source):
+        """Adds a page; pages must be added parents first"""
+        number = len(self.project['pages'])
+        meta = dict(meta, body='pages/%05d.xhtml' % number,
+                    source='pages/%05d.textile' % number)
+        for key, content in [('body', body), ('source', source)]:
+            with codecs.open(os.path.join(self.path, meta[key]), 'w',
+                             encoding='utf8') as f:
+                f.write(content)
+        self.project['pages'].append(meta)
+
+    def close(self):
+        with open(os.path.join(self.path, 'project.json'), 'w') as f:
+            f.write(json.dumps(self.project, indent=4))
+
+
+def read_bundle(path):
+    """Returns the projects of an export bundle, with their pages"""
+    projects = []
+    for proj_name in sorted(os.listdir(path)):
+        manifest = os.path.join(path, proj_name, 'project.json')
+        if not os.path.isfile(manifest):
+            continue
+        with open(manifest) as f:
+            project = json.loads(f.read())
+        project['pages'] = [ExportedPage(os.path.join(path, proj_name), meta)
+                            for meta in project['pages']]
+        projects.append(project)
+    return projects
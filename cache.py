@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+class AttachmentCache(object):
+    """Content-addressed on-disk store of redmine attachments.
+    Each distinct file is stored once, under the sha256 of its content, and
+    looked up by redmine attachment id or by redmine's own checksum. Least
+    recently used files are evicted once the cache grows beyond `max_size`
+    bytes.
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.db = sqlite3.connect(os.path.join(path, 'index.sqlite'),
+                                  check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS blobs ('
+                'digest TEXT PRIMARY KEY, size INTEGER, used REAL)')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS attachments ('
+                'attachment_id INTEGER PRIMARY KEY, digest TEXT)')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS checksums ('
+                'checksum TEXT PRIMARY KEY, digest TEXT)')
+
+    def _execute(self, query, *args):
+        with self.lock, self.db:
+            return self.db.execute(query, args).fetchall()
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def get(self, attachment_id, checksum=None):
+        """Returns the cached attachment as an open file, or None"""
+        rows = self._execute(
+            'SELECT digest FROM attachments WHERE attachment_id = ?',
+            attachment_id)
+        if not rows and checksum:
+            rows = self._execute(
+                'SELECT digest FROM checksums WHERE checksum = ?', checksum)
+        if not rows:
+            return None
+        digest = rows[0][0]
+        try:
+            data = open(self.blob_path(digest), 'rb')
+        except IOError:
+            # evicted
+            return None
+        self._execute('UPDATE blobs SET used = ? WHERE digest = ?',
+                      time.time(), digest)
+        self._execute('INSERT OR REPLACE INTO attachments VALUES (?, ?)',
+                      attachment_id, digest)
+        return data
+
+    def put(self, attachment_id, chunks, checksum=None):
+        """Stores an attachment given as an iterable of chunks and returns it
+        as an open file
+        """
+        sha = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                for chunk in chunks:
+                    sha.update(chunk)
+                    size += len(chunk)
+                    tmp.write(chunk)
+            digest = sha.hexdigest()
+            path = self.blob_path(digest)
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    # created by another thread in the meantime
+                    pass
+            os.rename(tmp_path, path)
+        except:
+            # e.g. the download failed; don't leave the partial file behind
+            os.remove(tmp_path)
+            raise
+        data = open(path, 'rb')
+        self._execute('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)',
+                      digest, size, time.time())
+        self._execute('INSERT OR REPLACE INTO attachments VALUES (?, ?)',
+                      attachment_id, digest)
+        if checksum:
+            self._execute('INSERT OR REPLACE INTO checksums VALUES (?, ?)',
+                          checksum, digest)
+        self.evict()
+        return data
+
+    def evict(self):
+        """Removes least recently used files until the cache fits max_size"""
+        rows = self._execute('SELECT digest, size FROM blobs ORDER BY used DESC')
+        total = 0
+        for idx, (digest, size) in enumerate(rows):
+            # always keep the most recently used file
+            if idx and total + size > self.max_size:
+                try:
+                    os.remove(self.blob_path(digest))
+                except OSError:
+                    pass
+                for table in ['blobs', 'attachments', 'checksums']:
+                    self._execute(
+                        'DELETE FROM %s WHERE digest = ?' % table, digest)
+            else:
+                total += size
+
+
+class ConversionCache(object):
+    """Persistent store of converted page bodies, keyed by a hash of
+    everything the conversion depends on.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS conversions ('
+                'key TEXT PRIMARY KEY, body TEXT)')
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True)).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT body FROM conversions WHERE key = ?', (key,)).fetchall()
+        return rows[0][0] if rows else None
+
+    def put(self, key, body):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO conversions VALUES (?, ?)',
+                            (key, body))
@@ -1,11 +1,14 @@
+import io
 import json
-import xmlrpclib
-import time
+import os
 import urllib
+import uuid
 
 import logbook
 import requests
 
+from ratelimit import RateLimiter
+
 log = logbook.Logger('confluence')
 
 class InvalidXML(Exception):
@@ -20,8 +23,73 @@ class DuplicateWikiPage(Exception):
     pass
 
 
+def attachment_filename(filename):
+    """Returns the name Confluence stores an uploaded attachment under"""
+    return urllib.quote_plus(filename.encode('utf8'))
+
+
+def rename_duplicate(filename):
+    """Renames an attachment whose name is already taken on a page"""
+    if '.' not in filename:
+        return filename + '_'
+    # Append an underscore to the filename, before extension
+    return filename.replace('.', '_.')
+
+
+class MultipartBody(object):
+    """File-like multipart/form-data body which streams its file part.
+    requests sends it block by block, so the file is never held in memory.
+    """
+    def __init__(self, fields, filename, fileobj):
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % boundary
+        head = ''
+        for name, value in fields.iteritems():
+            if isinstance(value, unicode):
+                value = value.encode('utf8')
+            head += ('--%s\r\nContent-Disposition: form-data; name="%s"'
+                     '\r\n\r\n%s\r\n' % (boundary, name, value or ''))
+        head += ('--%s\r\nContent-Disposition: form-data; name="file"; '
+                 'filename="%s"\r\nContent-Type: application/octet-stream'
+                 '\r\n\r\n' % (boundary, filename))
+        if isinstance(fileobj, str):
+            fileobj = io.BytesIO(fileobj)
+        self.fileobj = fileobj
+        self.parts = [io.BytesIO(head), fileobj,
+                      io.BytesIO('\r\n--%s--\r\n' % boundary)]
+        fileobj.seek(0, os.SEEK_END)
+        self.length = len(head) + fileobj.tell() + len(self.parts[2].getvalue())
+        self.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if offset != 0 or whence != os.SEEK_SET:
+            raise IOError('MultipartBody can only be rewound')
+        for part in self.parts:
+            part.seek(0)
+        self.current = 0
+        self.position = 0
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        retval = ''
+        while self.current < len(self.parts) and (size < 0 or len(retval) < size):
+            chunk = self.parts[self.current].read(
+                -1 if size < 0 else size - len(retval))
+            if not chunk:
+                self.current += 1
+            retval += chunk
+        self.position += len(retval)
+        return retval
+
+
 class Confluence(object):
-    def __init__(self, base_url, username, password, verify_ssl=True):
+    def __init__(self, base_url, username, password, verify_ssl=True,
+                 pool_size=10, limiter=None):
         self.base_url = base_url + '/rest/api'
         self.username = username
         self.password = password
@@ -29,27 +97,45 @@ class Confluence(object):
         if not verify_ssl:
             requests.packages.urllib3.disable_warnings()
         self.headers = {'Content-type': 'application/json'}
-        self.server = xmlrpclib.ServerProxy('%s/rpc/xmlrpc' % base_url)
-        self.token = self.server.confluence2.login(self.username, self.password)
-
-    def _post(self, url, data, files=None, headers=None, jsonify=True, retry=5):
-        if not retry:
-            raise RuntimeError('Number of retries exceeded! Aborting.')
+        # One keep-alive connection pool shared by every REST call
+        self.session = requests.Session()
+        self.session.auth = (self.username, self.password)
+        self.session.verify = self.verify_ssl
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # may be shared with other clients to throttle them all together
+        self.limiter = limiter or RateLimiter()
+
+    def _request(self, method, url, retry=5, **kwargs):
+        """Makes a request through the rate limiter, retrying connection
+        errors and throttled requests
+        """
+        def request():
+            if hasattr(kwargs.get('data'), 'seek'):
+                # rewind streamed bodies left half-sent by a failed attempt
+                kwargs['data'].seek(0)
+            return self.limiter.observe(
+                self.session.request(method, url, **kwargs))
+        return self.limiter.call(request, retry)
+
+    def _post(self, url, data, files=None, headers=None, jsonify=True, retry=5,
+              method='POST'):
         if headers is None:
             headers = self.headers
         if jsonify:
             data = json.dumps(data)
-        try:
-            res = requests.post(url, auth=(self.username, self.password),
-                                data=data, headers=headers, files=files,
-                                verify=self.verify_ssl)
-        except (requests.exceptions.ConnectionError,
-                requests.exceptions.Timeout) as e:
-            log.warn('Exception occurred making request: {0}. Retrying...'.format(e))
-            time.sleep(1)
-            return self._post(url, data, files=files, headers=headers,
-                              jsonify=jsonify, retry=retry-1)
-        if not 200 <= res.status_code < 300:
+        fields = data
+        attempt = 0
+        while attempt < retry:
+            if files:
+                data = MultipartBody(fields, *files['file'])
+                headers = dict(headers, **{'Content-Type': data.content_type})
+            res = self._request(method, url, retry=retry, data=data,
+                                headers=headers)
+            if 200 <= res.status_code < 300:
+                return res.json()
             try:
                 error = json.loads(res.text)
             except ValueError:
@@ -58,18 +144,36 @@ class Confluence(object):
                 raise InvalidXML(error['message'])
             elif 'Read timed out' in error['message']:
                 log.warn('Timed out. Retrying...')
-                time.sleep(1)
-                return self._post(url, data, files=files, headers=headers,
-                                  jsonify=jsonify, retry=retry-1)
+                self.limiter.throttle('timeouts', attempt)
+                attempt += 1
             elif 'same file name as an existing attachment' in error['message']:
-                # Append an underscore to the filename, before extension
-                files['file'] = (files['file'][0].replace('.', '_.'), files['file'][1])
-                return self._post(url, data, files=files, headers=headers,
-                                  jsonify=jsonify, retry=retry)
+                files['file'] = (rename_duplicate(files['file'][0]), files['file'][1])
             elif 'A page with this title already exists' in error['message']:
                 raise DuplicateWikiPage()
-            raise RuntimeError(res.text)
-        return res.json()
+            else:
+                raise RuntimeError(res.text)
+        raise RuntimeError('Number of retries exceeded! Aborting.')
+
+    def get_titles(self, space, limit=500):
+        """Returns the titles of all pages in a space"""
+        titles = []
+        url = '{0}/content'.format(self.base_url)
+        while True:
+            res = self._request('GET', url, headers=self.headers, params={
+                'spaceKey': space, 'type': 'page', 'limit': limit,
+                'start': len(titles)})
+            if res.status_code == 404:
+                # space doesn't exist yet
+                return titles
+            res.raise_for_status()
+            data = res.json()
+            results = data['results']
+            titles.extend(page['title'] for page in results)
+            # Confluence caps the limit we ask for at its own maximum, and
+            # tells whether there are more pages with a "next" link
+            if not results or ('next' not in data.get('_links', {}) and
+                               len(results) < data.get('limit', limit)):
+                return titles
 
     def create_space(self, key, name, description):
         data = {
@@ -87,7 +191,8 @@ class Confluence(object):
             # space already exists
             log.warn('Space {0} already exists, skipping creation'.format(key))
 
-    def create_page(self, title, body, space, username, display_name):
+    def create_page(self, title, body, space, username, display_name,
+                    parent_id=None):
         data = {
             "type": "page",
             "title": title,
@@ -106,10 +211,13 @@ class Confluence(object):
                 }
             }
         }
+        if parent_id:
+            data['ancestors'] = [{'id': parent_id}]
         return self._post('{0}/content'.format(self.base_url), data)
 
     def add_attachment(self, confluence_id, filename, data, description):
-        filename = urllib.quote_plus(filename.encode('utf8'))
+        """Uploads an attachment. `data` may be a string or a seekable file"""
+        filename = attachment_filename(filename)
         url = '{0}/content/{1}/child/attachment'.format(
             self.base_url, confluence_id)
         return self._post(url, {'comment': description},
@@ -117,16 +225,11 @@ class Confluence(object):
                           headers={'X-Atlassian-Token': 'nocheck'},
                           jsonify=False)
 
-    def move_page(self, page_id, target_page_id):
-        self.server.confluence2.movePage(
-            self.token, str(page_id), str(target_page_id), 'append')
-
     def get_page(self, page_id):
-        url = '{0}/content/{1}?expand=body.view,version'.format(
-            self.base_url, page_id)
-        return requests.get(
-            url, auth=(self.username, self.password), headers=self.headers,
-            verify=self.verify_ssl).json()
+        # only the title and version are needed; expanding the body would
+        # have Confluence render the whole page
+        url = '{0}/content/{1}?expand=version'.format(self.base_url, page_id)
+        return self._request('GET', url, headers=self.headers).json()
 
     def update_page(self, page_id, content):
         current_page = self.get_page(page_id)
@@ -146,7 +249,5 @@ class Confluence(object):
                 "number": ver_number
             }
         }
-        return requests.put('{0}/content/{1}'.format(self.base_url, page_id),
-                            auth=(self.username, self.password),
-                            headers=self.headers, data=json.dumps(data),
-                            verify=self.verify_ssl).json()
+        return self._post('{0}/content/{1}'.format(self.base_url, page_id),
+                          data, method='PUT')
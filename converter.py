@@ -0,0 +1,237 @@
+import atexit
+import multiprocessing
+import os
+import Queue
+import re
+import resource
+import signal
+import threading
+import traceback
+import uuid
+
+import logbook
+import pypandoc
+
+log = logbook.Logger('converter')
+
+# Bodies whose conversion depends on the rest of the document: footnotes
+# are numbered and collected at the end of the whole pandoc output.
+STANDALONE_REGEX = re.compile(r'^fn\d+', re.MULTILINE)
+# Heading ids, without the "-1" suffixes pandoc gives repeated ones
+HEADING_ID_REGEX = re.compile(r'<h[1-6] id="([^"]*?)(?:-\d+)*"')
+
+
+def textile_to_html(body):
+    return pypandoc.convert(body, 'html', format='textile')
+
+
+def textile_to_html_many(bodies):
+    """Converts several textile bodies with a single pandoc invocation.
+    The bodies are joined with a separator paragraph, which also ends any
+    extended block (e.g. "bc..") of the body before it, and the output is
+    split on it again. Bodies which may convert differently in company (or which
+    the separator didn't survive) are converted on their own, so the result
+    is the same as converting each body separately.
+    """
+    retval = [None] * len(bodies)
+    batched = []
+    for idx, body in enumerate(bodies):
+        if body.strip() and not STANDALONE_REGEX.search(body):
+            batched.append(idx)
+    if len(batched) > 1:
+        separator = 'R2CSEPARATOR%s' % uuid.uuid4().hex
+        html = textile_to_html(
+            (u'\n\np. %s\n\n' % separator).join(bodies[idx] for idx in batched))
+        parts = html.split(u'<p>%s</p>\n' % separator)
+        if len(parts) == len(batched):
+            # pandoc gives a heading a "-1" suffix if an earlier body in the
+            # batch had a heading with the same id
+            earlier_ids = set()
+            for idx, part in zip(batched, parts):
+                ids = set(HEADING_ID_REGEX.findall(part))
+                if not ids & earlier_ids:
+                    retval[idx] = part
+                earlier_ids |= ids
+        else:
+            log.warn('Batched pandoc conversion failed, converting one by one')
+    for idx, body in enumerate(bodies):
+        if retval[idx] is None:
+            retval[idx] = textile_to_html(body)
+    return retval
+
+
+class PandocBatcher(object):
+    """Converts textile to html for many threads at once.
+    While pandoc is busy with one batch, bodies submitted by other threads
+    (e.g. the --workers pool) queue up and are converted together in the
+    next pandoc invocation, rather than starting one pandoc per page.
+    """
+    def __init__(self, batch_size=20):
+        self.batch_size = batch_size
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+        atexit.register(self.stop)
+
+    def convert(self, body):
+        with self.lock:
+            # the thread doesn't survive when forked into a worker process
+            if self.thread is None or self.pid != os.getpid():
+                self.queue = Queue.Queue()
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            result = {'done': threading.Event()}
+            self.queue.put((body, result))
+        result['done'].wait()
+        if 'error' in result:
+            raise result['error']
+        return result['html']
+
+    def stop(self):
+        """Ends the thread, rather than leaving it waiting for bodies while
+        the interpreter shuts down
+        """
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                return
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if None in batch:
+                # stop() was called; convert what was submitted before it
+                stopped = True
+                batch = [item for item in batch if item is not None]
+            try:
+                htmls = textile_to_html_many([body for body, _ in batch])
+            except Exception:
+                # Isolate the failure to the page(s) causing it
+                htmls = []
+                for body, result in batch:
+                    try:
+                        htmls.append(textile_to_html(body))
+                    except Exception as e:
+                        htmls.append(None)
+                        result['error'] = e
+            for html, (_, result) in zip(htmls, batch):
+                result['html'] = html
+                result['done'].set()
+
+
+class ConversionFailed(Exception):
+    """A conversion ran out of time or memory"""
+    pass
+
+
+def serve(conn, memory_limit, initializer, initargs):
+    """Main loop of a conversion worker process"""
+    # own process group, so that pandoc is killed along with the worker
+    os.setsid()
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_DATA, (memory_limit, memory_limit))
+    if initializer:
+        initializer(*initargs)
+    while True:
+        try:
+            func, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            result = ('ok', func(*args))
+        except MemoryError:
+            result = ('limit', 'out of memory')
+        except Exception as e:
+            # pandoc only tells it ran out of memory in its error message
+            if 'memory' in str(e):
+                result = ('limit', str(e))
+            else:
+                result = ('error', traceback.format_exc())
+        conn.send(result)
+
+
+class ConversionPool(object):
+    """Runs conversions in worker processes, so that they use all cores and
+    a runaway conversion can be stopped. A conversion taking longer than
+    `timeout` seconds is killed, along with its pandoc, and a worker using
+    more than `memory_limit` bytes fails; both raise ConversionFailed.
+    """
+    def __init__(self, processes=None, timeout=None, memory_limit=None,
+                 initializer=None, initargs=()):
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.initializer = initializer
+        self.initargs = initargs
+        self.processes = processes or multiprocessing.cpu_count()
+        self.idle = Queue.Queue()
+        for _ in range(self.processes):
+            self.idle.put(self.start_worker())
+
+    def start_worker(self):
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=serve, args=(
+            child_conn, self.memory_limit, self.initializer, self.initargs))
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        return process, conn
+
+    def kill_worker(self, worker):
+        process, conn = worker
+        # the worker may not have started its own process group yet
+        for kill in [os.killpg, os.kill]:
+            try:
+                kill(process.pid, signal.SIGKILL)
+            except OSError:
+                # already gone
+                pass
+        process.join()
+        conn.close()
+
+    def convert(self, func, *args, **kwargs):
+        """Calls func(*args) in a worker process and returns the result.
+        `func` must be a module level function. A `timeout` keyword argument
+        replaces the pool's timeout for this call.
+        """
+        timeout = kwargs.pop('timeout', self.timeout)
+        if kwargs:
+            raise TypeError('Unexpected arguments: %s' % ', '.join(kwargs))
+        worker = self.idle.get()
+        process, conn = worker
+        try:
+            conn.send((func, args))
+            if conn.poll(timeout):
+                status, result = conn.recv()
+            else:
+                status, result = 'limit', 'timed out after %s seconds' % timeout
+        except (EOFError, IOError):
+            # killed, e.g. by the OOM killer
+            status, result = 'limit', 'worker died'
+        except:
+            self.idle.put(worker)
+            raise
+        if status == 'limit':
+            # don't reuse a worker which may be stuck or short of memory
+            self.kill_worker(worker)
+            worker = self.start_worker()
+        self.idle.put(worker)
+        if status == 'limit':
+            raise ConversionFailed(result)
+        if status == 'error':
+            raise RuntimeError('Conversion failed:\n%s' % result)
+        return result
+
+    def close(self):
+        while not self.idle.empty():
+            self.kill_worker(self.idle.get())
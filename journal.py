@@ -0,0 +1,86 @@
+import json
+import sqlite3
+import threading
+
+
+class Journal(object):
+    """Persistent record of migration progress, used to resume an
+    interrupted run without recreating pages that already exist.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS pages ('
+                'project TEXT, title TEXT, confluence_title TEXT, '
+                'confluence_id TEXT, parent TEXT, status TEXT, '
+                'version INTEGER, updated_on TEXT, '
+                'PRIMARY KEY (project, title))')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS attachments ('
+                'project TEXT, title TEXT, attachment_id INTEGER, '
+                'filename TEXT, PRIMARY KEY (project, title, attachment_id))')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS stats ('
+                'project TEXT PRIMARY KEY, data TEXT)')
+
+    def _execute(self, query, *args):
+        with self.lock, self.db:
+            return self.db.execute(query, args).fetchall()
+
+    def reset(self):
+        """Forgets all recorded progress"""
+        for table in ['pages', 'attachments', 'stats']:
+            self._execute('DELETE FROM %s' % table)
+
+    def get_page(self, project, title):
+        rows = self._execute(
+            'SELECT * FROM pages WHERE project = ? AND title = ?',
+            project, title)
+        return dict(rows[0]) if rows else None
+
+    def pages(self, project):
+        return [dict(row) for row in self._execute(
+            'SELECT * FROM pages WHERE project = ?', project)]
+
+    def page_created(self, project, title, confluence_title, confluence_id,
+                     parent, version=None, updated_on=None):
+        self._execute(
+            'INSERT OR REPLACE INTO pages (project, title, confluence_title, '
+            'confluence_id, parent, status, version, updated_on) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            project, title, confluence_title, confluence_id, parent,
+            'created', version, updated_on)
+
+    def page_updated(self, project, title, version, updated_on):
+        self._execute(
+            'UPDATE pages SET version = ?, updated_on = ? '
+            'WHERE project = ? AND title = ?',
+            version, updated_on, project, title)
+
+    def set_status(self, project, title, status):
+        self._execute(
+            'UPDATE pages SET status = ? WHERE project = ? AND title = ?',
+            status, project, title)
+
+    def attachments_added(self, project, title):
+        """Returns the ids of attachments already uploaded for a page"""
+        return set(row['attachment_id'] for row in self._execute(
+            'SELECT attachment_id FROM attachments '
+            'WHERE project = ? AND title = ?', project, title))
+
+    def attachment_added(self, project, title, attachment_id, filename):
+        self._execute(
+            'INSERT OR REPLACE INTO attachments VALUES (?, ?, ?, ?)',
+            project, title, attachment_id, filename)
+
+    def load_stats(self, project):
+        rows = self._execute(
+            'SELECT data FROM stats WHERE project = ?', project)
+        return json.loads(rows[0]['data']) if rows else None
+
+    def save_stats(self, project, stats):
+        self._execute('INSERT OR REPLACE INTO stats VALUES (?, ?)',
+                      project, json.dumps(stats))
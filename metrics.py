@@ -0,0 +1,125 @@
+import bisect
+from contextlib import contextmanager
+import threading
+import time
+
+# Upper bounds (in seconds) of the histogram buckets
+BUCKETS = (0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+
+def new_stage():
+    return {
+        'count': 0,
+        'seconds': 0.0,
+        'bytes': 0,
+        'buckets': [0] * (len(BUCKETS) + 1)
+    }
+
+
+class Metrics(object):
+    """Time spent, data handled and calls made in each stage of the
+    migration, in total and per project. The project is that of the
+    surrounding project() block of the current thread.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def project(self, proj_name):
+        previous = getattr(self.local, 'project', None)
+        self.local.project = proj_name
+        try:
+            yield
+        finally:
+            self.local.project = previous
+
+    @contextmanager
+    def time(self, stage, size=0):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, time.time() - start, size)
+
+    def record(self, stage, seconds, size=0):
+        projects = set([None, getattr(self.local, 'project', None)])
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            for project in projects:
+                entry = self.stages.setdefault(project, {}).setdefault(
+                    stage, new_stage())
+                entry['count'] += 1
+                entry['seconds'] += seconds
+                entry['bytes'] += size
+                entry['buckets'][bucket] += 1
+
+    def take(self):
+        """Returns the totals recorded so far and starts afresh"""
+        with self.lock:
+            stages = self.stages.get(None, {})
+            self.stages = {}
+        return stages
+
+    def merge(self, stages):
+        """Adds totals taken from another Metrics, e.g. of a worker process"""
+        projects = set([None, getattr(self.local, 'project', None)])
+        with self.lock:
+            for project in projects:
+                for stage, other in stages.iteritems():
+                    entry = self.stages.setdefault(project, {}).setdefault(
+                        stage, new_stage())
+                    for key in ['count', 'seconds', 'bytes']:
+                        entry[key] += other[key]
+                    entry['buckets'] = [
+                        a + b for a, b in zip(entry['buckets'], other['buckets'])]
+
+    def report(self):
+        """Returns the metrics by project ('total' for all projects) and
+        stage, with cumulative histograms
+        """
+        retval = {}
+        with self.lock:
+            for project, stages in self.stages.iteritems():
+                retval[project or 'total'] = report = {}
+                for stage, entry in stages.iteritems():
+                    histogram = {}
+                    count = 0
+                    for bound, bucket in zip(BUCKETS + ('+Inf',),
+                                             entry['buckets']):
+                        count += bucket
+                        histogram[str(bound)] = count
+                    report[stage] = {
+                        'count': entry['count'],
+                        'seconds': entry['seconds'],
+                        'bytes': entry['bytes'],
+                        'histogram': histogram
+                    }
+        return retval
+
+    def prometheus(self, counters=None):
+        """Returns the metrics, and any extra `counters`, in the Prometheus
+        text exposition format
+        """
+        lines = ['# TYPE redmine2confluence_stage_seconds histogram']
+        totals = ['# TYPE redmine2confluence_stage_bytes counter']
+        for project, stages in sorted(self.report().iteritems()):
+            for stage, entry in sorted(stages.iteritems()):
+                labels = 'project="%s",stage="%s"' % (project, stage)
+                for bound in BUCKETS + ('+Inf',):
+                    lines.append('redmine2confluence_stage_seconds_bucket'
+                                 '{%s,le="%s"} %d' % (
+                                     labels, bound, entry['histogram'][str(bound)]))
+                lines.append('redmine2confluence_stage_seconds_sum{%s} %f' % (
+                    labels, entry['seconds']))
+                lines.append('redmine2confluence_stage_seconds_count{%s} %d' % (
+                    labels, entry['count']))
+                totals.append('redmine2confluence_stage_bytes{%s} %d' % (
+                    labels, entry['bytes']))
+        lines.extend(totals)
+        for name, value in sorted((counters or {}).iteritems()):
+            name = 'redmine2confluence_%s' % name.replace(' ', '_')
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %s' % (name, value if value is not None else 'NaN'))
+        return '\n'.join(lines) + '\n'
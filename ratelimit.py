@@ -0,0 +1,156 @@
+from collections import deque
+import email.utils
+import random
+import threading
+import time
+
+import logbook
+import requests
+
+log = logbook.Logger('ratelimit')
+
+# Responses with which servers ask us to back off
+THROTTLE_STATUS = (429, 503)
+
+
+class Throttled(Exception):
+    pass
+
+
+def backoff(attempt, base=0.5, cap=30):
+    """Seconds to wait before retry number `attempt` (exponential, jittered)"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_after(response):
+    """Returns the seconds a response's Retry-After header asks to wait"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0, email.utils.mktime_tz(date) - time.time())
+
+
+class RateLimiter(object):
+    """Token bucket shared by every client talking to the servers.
+    Requests are let through at up to `rate` per second (unlimited if None).
+    When a server throttles us or times out, everyone waits for the
+    requested time and the rate is halved; each successful request raises
+    it again by a few percent, up to `rate`.
+    """
+    def __init__(self, rate=None, min_rate=0.5, increase=1.05):
+        if rate is not None and rate <= 0:
+            raise ValueError('rate must be positive, or None for unlimited')
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.increase = increase
+        # rate at which an unlimited limiter was first throttled
+        self.ceiling = None
+        self.tokens = 1.0
+        self.updated = time.time()
+        self.blocked_until = 0
+        # start times of the requests of the last second
+        self.recent = deque()
+        self.lock = threading.Lock()
+        self.counters = {
+            'requests': 0,
+            'throttled': 0,
+            'timeouts': 0,
+            'waits': 0,
+            'wait time': 0.0
+        }
+
+    def acquire(self):
+        """Blocks until a request may be made"""
+        start = time.time()
+        while True:
+            with self.lock:
+                now = time.time()
+                if self.rate is not None:
+                    self.tokens = min(max(1.0, self.rate),
+                                      self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                delay = self.blocked_until - now
+                if delay <= 0:
+                    if self.rate is None or self.tokens >= 1:
+                        self._issue(now, start)
+                        return
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def _issue(self, now, start):
+        if self.rate is not None:
+            self.tokens -= 1
+        self.recent.append(now)
+        while self.recent[0] < now - 1:
+            self.recent.popleft()
+        self.counters['requests'] += 1
+        if now > start:
+            self.counters['waits'] += 1
+            self.counters['wait time'] += now - start
+
+    def throttle(self, reason, attempt=0, wait=None):
+        """Slows everyone down after a throttled or timed out request.
+        `reason` is the counter to increment, `wait` the seconds the server
+        asked us to wait (otherwise a backoff for retry number `attempt`).
+        """
+        with self.lock:
+            now = time.time()
+            self.counters[reason] += 1
+            if now < self.blocked_until:
+                # already slowed down for a concurrent request
+                return
+            if self.rate is None:
+                self.ceiling = self.rate = max(len(self.recent), self.min_rate)
+                self.tokens = 0.0
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.blocked_until = now + (wait if wait is not None
+                                        else backoff(attempt))
+        log.warn(u'Throttled ({0}), slowing down to {1:.1f} requests/s'.format(
+            reason, self.rate))
+
+    def succeed(self):
+        """Speeds up again after a successful request"""
+        with self.lock:
+            if self.rate is None:
+                return
+            self.rate *= self.increase
+            if self.max_rate is not None:
+                self.rate = min(self.rate, self.max_rate)
+            elif self.rate >= self.ceiling:
+                # back to full speed
+                self.rate = None
+
+    def observe(self, response, *args, **kwargs):
+        """Adapts to a response; raises Throttled if the server throttled us.
+        Can be used as a requests response hook.
+        """
+        if response.status_code in THROTTLE_STATUS:
+            self.throttle('throttled', wait=retry_after(response))
+            raise Throttled(response.status_code)
+        self.succeed()
+        return response
+
+    def call(self, func, retry=5):
+        """Calls `func` once the limiter allows, retrying when throttled"""
+        for attempt in range(retry):
+            self.acquire()
+            try:
+                return func()
+            except Throttled as e:
+                log.warn('Server returned {0}. Retrying...'.format(e))
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                log.warn('Exception occurred making request: {0}. Retrying...'.format(e))
+                self.throttle('timeouts', attempt)
+        raise RuntimeError('Number of retries exceeded! Aborting.')
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, rate=self.rate)
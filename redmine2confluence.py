@@ -1,291 +1,1409 @@
 #!/usr/bin/env python
 
+import argparse
+import atexit
+from collections import deque
 from HTMLParser import HTMLParser
+import htmlentitydefs
 import json
+from multiprocessing.pool import ThreadPool
+import Queue
 import re
+import tempfile
+import threading
 import traceback
 import urllib
+from xml.parsers import expat
 
 from bs4 import BeautifulSoup
 import logbook
 from redmine import Redmine
 from redmine.exceptions import BaseRedmineError, ResourceAttrError
-import requests
 import pypandoc
+import requests
 import textile
 
-from confluence import Confluence, InvalidXML, DuplicateWikiPage
+from confluence import (Confluence, InvalidXML, DuplicateWikiPage,
+                        attachment_filename, rename_duplicate)
+from bundle import BundleWriter, ExportedPage, read_bundle
+from cache import AttachmentCache, ConversionCache
+from converter import ConversionFailed, ConversionPool, PandocBatcher
+from journal import Journal
+from metrics import Metrics
+from ratelimit import RateLimiter
 from settings import REDMINE, CONFLUENCE, PROJECTS, JIRA_URL, VERIFY_SSL
 
 log = logbook.Logger('redmine2confluence')
 STATS = {}
+STATS_LOCK = threading.Lock()
 SKIPPED_PROJECTS = []
+CHUNK_SIZE = 64 * 1024
+PANDOC = PandocBatcher()
+METRICS = Metrics()
+# Worker processes converting pages, if not converting in-line
+CONVERTER = None
+ATTACHMENT_CACHE = None
+CONVERSION_CACHE = None
+# Bump whenever conversion output changes, to invalidate CONVERSION_CACHE
+CONVERTER_VERSION = 3
+
+LINK_TEMPLATE = u'<a href="%s">%s</a>'
+# Characters redmine removes from the titles of wiki pages
+TITLE_REMOVED_REGEX = re.compile(r'[,./?;|:]')
+ISSUE_URL = JIRA_URL + '/issues/?jql=%22External%20Issue%20ID%22%20~%20'
+# Yes, this won't handle nested pre's or code's, but we shouldn't need to.
+NOPROCESS_START_REGEX = re.compile('<code>|<pre>|<notextile>')
+NOPROCESS_END_REGEX = re.compile('</code>|</pre>|</notextile>')
+URL_PATTERN = (r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|'
+               r'(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+LINK_REGEX = re.compile(
+    # [[Article Name]] and [[Article Name|Some link text here]]
+    r'\[\[(?:(?P<page_title>[^]]+?)\|)?(?P<display_text>.+?)\]\]'
+    # URLs at the beginning of a line or after whitespace
+    r'|(?:^|(?P<url_space>\s))(?P<url>' + URL_PATTERN + ')'
+    # Redmine issue numbers
+    r'|\s#(?P<issue>[0-9]+)')
+NUCLEAR_REGEX = re.compile(
+    r'<(?!/?(?:code|pre|notextile)>|a href="[^"]*">|/a>)')
+# Storage format is xhtml, but may use html's named entities
+XML_PROLOG = '<!DOCTYPE storage [%s]><storage>' % ''.join(
+    '<!ENTITY %s "&#%d;">' % (name, codepoint)
+    for name, codepoint in htmlentitydefs.name2codepoint.iteritems()
+    if name not in ('amp', 'lt', 'gt', 'quot', 'apos'))
+# "&"s which don't start a character reference Confluence understands
+BARE_AMP_PATTERN = r'&(?!(?:#[0-9]+|#[xX][0-9a-fA-F]+|%s);)' % '|'.join(
+    sorted(set(htmlentitydefs.name2codepoint) | set(['apos'])))
+BARE_AMP_REGEX = re.compile(BARE_AMP_PATTERN)
+SRC_REGEX = re.compile(r'\ssrc="(?P<src>[^"]*)"')
+# Tables pandoc couldn't parse are left as paragraphs of their rows
+TABLE_PARAGRAPH_REGEX = re.compile(r'^<p>(\|.*?)</p>$', re.MULTILINE | re.DOTALL)
+IMG_TEMPLATE = u'<ac:image><ri:attachment ri:filename="%s" /></ac:image>'
+WIKI_URL_REGEX = re.compile(
+    r'(?:%s|http[s]?://(?:trondheim|redmine)(?:\.phi-tps\.local)?/redmine)'
+    r'/projects/(?P<project>[^/]+)/wiki/(?P<page_title>[^/]*)/?$' %
+    re.escape(REDMINE['url'].rstrip('/')))
+
+
+class XMLFixer(object):
+    """Makes html well-formed enough for Confluence's xhtml storage format.
+    Walks the tags once, keeping a stack of open elements. Tags which are
+    never closed (e.g. "<something like this>" in plain text), closing tags
+    without an opening tag and bare "<"s are escaped so they show up as text,
+    void elements are self-closed and unquoted attributes are quoted.
+    Images of attachments in `images` become Confluence attachment
+    references along the way.
+    """
+    TOKEN_REGEX = re.compile(
+        r'<!--.*?-->|<!\[CDATA\[.*?\]\]>|<![^<>]*>'
+        r'|<(?P<end>/)?(?P<name>[a-zA-Z][\w:.-]*)(?P<attrs>[^<>]*?)(?P<close>/)?>'
+        r'|(?P<lt><)|' + BARE_AMP_PATTERN, re.DOTALL)
+    ATTRS_REGEX = re.compile(
+        r'(?:\s+[^\s=/<>"\']+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*$')
+    ATTR_REGEX = re.compile(
+        r'([^\s=/<>"\']+)(?:\s*=\s*("[^"]*"|\'[^\']*\'|[^\s"\'>]+))?')
+    VOID_TAGS = set(['area', 'base', 'br', 'col', 'embed', 'hr', 'img',
+                     'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'])
+
+    def __init__(self, images=None):
+        self.images = images or {}
+
+    @staticmethod
+    def escape(token):
+        return token.replace('<', '&lt;').replace('>', '&gt;')
 
+    @staticmethod
+    def escape_value(value):
+        # e.g. the query strings of urls
+        return BARE_AMP_REGEX.sub('&amp;', value).replace('<', '&lt;')
+
+    def fix_attrs(self, attrs):
+        if self.ATTRS_REGEX.match(attrs):
+            return self.escape_value(attrs)
+        retval = u''
+        for name, value in self.ATTR_REGEX.findall(attrs):
+            if not value:
+                value = name
+            value = self.escape_value(value.strip('"\'').replace('"', '&quot;'))
+            retval += u' %s="%s"' % (name, value)
+        return retval
+
+    def fix_tags(self, html):
+        output = []
+        stack = []  # (tag name, index of its opening tag in output, tag)
+        pos = 0
+        for match in self.TOKEN_REGEX.finditer(html):
+            output.append(html[pos:match.start()])
+            pos = match.end()
+            token = match.group(0)
+            name = match.group('name')
+            if token == '&':
+                output.append('&amp;')
+            elif match.group('lt'):
+                output.append('&lt;')
+            elif not name:
+                # comments, CDATA, doctypes
+                output.append(token)
+            elif match.group('end'):
+                for idx in range(len(stack) - 1, -1, -1):
+                    if stack[idx][0].lower() == name.lower():
+                        break
+                else:
+                    output.append(self.escape(token))
+                    continue
+                # Anything opened after the matching tag was never closed
+                for _, unclosed, tag in stack[idx + 1:]:
+                    output[unclosed] = self.escape(tag)
+                output.append(u'</%s>' % stack[idx][0])
+                del stack[idx:]
+            else:
+                attrs = self.fix_attrs(match.group('attrs'))
+                if name.lower() == 'img' and self.images:
+                    src = SRC_REGEX.search(attrs)
+                    image = src and attachment_image(src.group('src'), self.images)
+                    if image:
+                        output.append(IMG_TEMPLATE % image)
+                        continue
+                if match.group('close') or name.lower() in self.VOID_TAGS:
+                    output.append(u'<%s%s />' % (name, attrs.rstrip()))
+                else:
+                    stack.append((name, len(output), token))
+                    output.append(u'<%s%s>' % (name, attrs))
+        output.append(html[pos:])
+        for _, unclosed, tag in stack:
+            output[unclosed] = self.escape(tag)
+        return u''.join(output)
 
-class XMLFixer(HTMLParser):
+
+class ThrottledRedmine(Redmine):
+    """Redmine client whose requests go through a (shared) rate limiter"""
+    def __init__(self, url, limiter, retry=5, **kwargs):
+        # lets the limiter see, and throttle on, every response
+        kwargs['requests'] = dict(kwargs.get('requests', {}),
+                                  hooks={'response': limiter.observe})
+        super(ThrottledRedmine, self).__init__(url, **kwargs)
+        self.limiter = limiter
+        self.retry = retry
+
+    def request(self, *args, **kwargs):
+        return self.limiter.call(
+            lambda: super(ThrottledRedmine, self).request(*args, **kwargs),
+            self.retry)
+
+
+def titleize(title):
+    """Returns the title of the redmine wiki page a link to `title` refers
+    to, the way redmine's Wiki.titleize makes it
+    """
+    title = TITLE_REMOVED_REGEX.sub('', re.sub(r'\s+', '_', title))
+    return title[:1].upper() + title[1:]
+
+
+class LinkIndex(object):
+    """Where the redmine wiki pages of all projects end up in Confluence, so
+    that links to them, also from other projects, point at the right page.
+    Filled in before any page is converted, and kept up to date as pages
+    are renamed and created.
+    """
     def __init__(self):
-        HTMLParser.__init__(self)
-        self.tags = []
+        self.pages = {}
+        self.lock = threading.Lock()
 
-    def handle_starttag(self, tag, attrs):
-        self.tags.insert(0, tag)
+    @staticmethod
+    def key(project, title):
+        # redmine ignores case when looking pages up
+        return project, titleize(title).lower()
 
-    def handle_endtag(self, tag):
+    def add(self, project, title, space, confluence_title, page_id=None):
+        with self.lock:
+            self.pages[self.key(project, title)] = {
+                'space': space,
+                'title': confluence_title,
+                'id': page_id
+            }
+
+    def get(self, project, title):
+        return self.pages.get(self.key(project, title))
+
+    def path(self, project, title):
+        """Returns the Confluence path of a redmine page, or None"""
+        page = self.get(project, title)
+        if page is None:
+            return None
+        return '/display/%s/%s' % (page['space'], urllib.quote_plus(
+            page['title'].replace('_', ' ').encode('utf8')))
+
+
+LINK_INDEX = LinkIndex()
+
+
+class UserCache(object):
+    """Resolves redmine authors to Confluence usernames, requesting each
+    redmine user at most once.
+    """
+    def __init__(self, redmine):
+        self.redmine = redmine
+        self.logins = {}
+        self.lock = threading.Lock()
+
+    def prefetch(self):
+        """Loads all users in bulk (requires an admin api key)"""
         try:
-            self.tags.remove(tag)
-        except ValueError:
-            pass
+            logins = dict((user.id, user.login) for user in self.redmine.user.all())
+        except BaseRedmineError as e:
+            log.warn(u"Could not prefetch redmine users: '{0}'".format(e.message))
+            return
+        with self.lock:
+            self.logins.update(logins)
+        log.info(u"Prefetched {0} redmine users".format(len(logins)))
 
-    def fix_tags(self, html):
-        self.feed(html)
-        for tag in self.tags:
-            # tags in self.tags are all lower case, so regex that shit:
-            regex = re.compile(re.escape('<%s>' % tag), re.IGNORECASE)
-            matches = re.findall(regex, html)
-            for match in matches:
-                fixed = match.replace('<', '&lt;').replace('>', '&gt;')
-                html = html.replace(match, fixed)
-            if not matches:
-                # wasn't matched. Probably <something like this>, with 'like'
-                # and 'this' interpreted as tag attributes.
-                # try again, just converting the open bracket
-                regex = re.compile(re.escape('<%s' % tag), re.IGNORECASE)
-                matches = re.findall(regex, html)
-                for match in matches:
-                    fixed = match.replace('<', '&lt;')
-                    html = html.replace(match, fixed)
-        return html
+    def lookup(self, author):
+        """Returns (username, display name) for an author of a wiki page"""
+        with self.lock:
+            login = self.logins.get(author.id)
+        if login is None:
+            with METRICS.time('author lookup'):
+                login = author.refresh().login
+            with self.lock:
+                self.logins[author.id] = login
+        return login, author.name
 
 
 def convert_textile(body):
-    """Convert textile using pandoc and python-textile.
-    If the number of tables in the two doesn't match, go through the pandoc
-    version and replace unconverted tables with their equivalents from
-    python-textile.
-    Otherwise, just return the pandoc version untouched.
-    """
-    pandoc_conv = pypandoc.convert(body, 'html', format='textile')
-    pandoc_soup = BeautifulSoup(pandoc_conv)
-    textile_conv = textile.textile(body)
-    textile_soup = BeautifulSoup(textile_conv)
-    if len(pandoc_soup.find_all('table')) != len(textile_soup.find_all('table')):
-        retval = u''
-        for line in pandoc_conv.split('\n'):
-            if line.startswith('<p>|'):
-                retval += textile.textile(line[3:-4].replace('<br />', '\n'))
-            else:
-                retval += line
+    """Convert textile using pandoc.
+    Tables pandoc couldn't parse are left as paragraphs starting with "|";
+    those are replaced by python-textile's conversion, if it made a table
+    of them. Otherwise, just return the pandoc version untouched.
+    """
+    def replace(match):
+        table = textile.textile(match.group(1).replace('<br />\n', '\n'))
+        return table if '<table' in table else match.group(0)
+    html = PANDOC.convert(body)
+    if '<p>|' not in html:
+        return html
+    return TABLE_PARAGRAPH_REGEX.sub(replace, html)
+
+
+def translate_wiki_url(url):
+    """Returns the Confluence equivalent of a redmine wiki page url"""
+    match = WIKI_URL_REGEX.match(url)
+    if not match:
+        return url
+    redmine_project = match.group('project')
+    path = LINK_INDEX.path(redmine_project, urllib.unquote(
+        match.group('page_title').encode('utf8')).decode('utf8'))
+    if path:
+        return CONFLUENCE['url'] + path
+    page_title = match.group('page_title').replace('_', '+')
+    try:
+        return '%s/display/%s/%s' % (
+            CONFLUENCE['url'], PROJECTS[redmine_project], page_title)
+    except KeyError:
+        log.error('Link translation failed: Project "%s" not mapped!' % redmine_project)
+        return url
+
+
+def wiki_link_path(target_page, space, project=None):
+    """Returns the Confluence path of the page a [[wiki link]] in `project`
+    refers to. [[other_project:Page]] refers to a page of another project.
+    """
+    if ':' in target_page:
+        other_project, page_title = target_page.split(':', 1)
+        if other_project in PROJECTS:
+            project, space = other_project, PROJECTS[other_project]
+            target_page = page_title
+    path = LINK_INDEX.path(project, target_page)
+    if path:
+        return path
+    target_page = urllib.quote_plus(
+        titleize(target_page).replace('_', ' ').encode('utf8'))
+    return '/display/%s/%s' % (space, target_page)
+
+
+def _replace_link(match, space, project=None):
+    if match.group('url'):
+        url = translate_wiki_url(match.group('url'))
+        prefix = u' ' if match.group('url_space') is not None else u''
+        return prefix + LINK_TEMPLATE % (url, url)
+    if match.group('issue'):
+        issue = match.group('issue')
+        return u' ' + LINK_TEMPLATE % (ISSUE_URL + issue, issue)
+    link_text = match.group('display_text')
+    target_page = match.group('page_title') or link_text
+    if target_page.startswith('http://') or target_page.startswith('https://'):
+        url = target_page
     else:
-        retval = pandoc_conv
-    return retval
+        url = wiki_link_path(target_page, space, project)
+    return LINK_TEMPLATE % (url, link_text)
 
 
-def convert_links(body, space):
-    """Make links clickable, convert links from old formats to new"""
-    link_template = '<a href="%s">%s</a>'
+def convert_links(body, space, project=None):
+    """Make links clickable, convert links from old formats to new.
+    `project` is the redmine project the body is from.
+    """
+    replace = lambda match: _replace_link(match, space, project)
     retval = []
     process = True
     for line in body.split('\n'):
-        # Yes, this won't handle nested pre's or code's, but we shouldn't need to.
-        if '<code>' in line or '<pre>' in line or '<notextile>' in line:
+        if NOPROCESS_START_REGEX.search(line):
             process = False
         if process:
-            # Convert wiki url links
-            wiki_link = ('(http[s]?://(trondheim|redmine)[.phi-tps.local]?/'
-                         'redmine/projects/(.*?)/wiki/(.*?)[/]?)')
-            for match in set(re.findall(wiki_link, line)):
-                url = match[0]
-                redmine_project = match[2]
-                page_title = match[3].strip('/').replace('_', '+').replace('_', '+')
-                try:
-                    new_url = '%s/display/%s/%s' % (
-                        CONFLUENCE['url'], PROJECTS[redmine_project], page_title)
-                except KeyError:
-                    log.error('Link translation failed: Project "%s" not mapped!' % redmine_project)
-                else:
-                    line.replace(url, new_url)
-
-            # Make links clickable
-            url_regex = ('http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|'
-                         '(?:%[0-9a-fA-F][0-9a-fA-F]))+')
-            for url in set(re.findall(url_regex, line)):
-                line = re.sub('^%s' % re.escape(url), link_template % (url, url), line)
-                line = re.sub('\s%s' % re.escape(url), u' '+link_template % (url, url), line)
-            # Convert issue #s
-            replacement = (' <a href="{0}/issues/?jql=%22External%20Issue%20ID%22%20~%20'
-                           '\g<1>">\g<1></a>'.format(JIRA_URL))
-            line = re.sub('\s#([0-9]+)', replacement, line)
-            # Convert [[Article Name]] and [[Article Name|Some link text here]]
-            regex = re.compile('(\[\[((?P<page_title>[^]]+?)(\|))?'
-                               '(?P<display_text>.+?)\]\])')
-            matches = set([(match[0], match[2], match[4]) for match in regex.findall(line)])
-            for match in matches:
-                link_text = match[2]
-                target_page = (match[1] or match[2])
-                if target_page.startswith('http://') or target_page.startswith('https://'):
-                    url = target_page
-                else:
-                    target_page = urllib.quote_plus(
-                        target_page.replace('_', ' ').replace('/', '').replace('.', '').encode('utf8'))
-                    url = '/display/%s/%s' % (space, target_page)
-                line = line.replace(match[0], link_template % (url, link_text))
-        if '</code>' in line or '</pre>' in line or '</notextile>' in line:
+            line = LINK_REGEX.sub(replace, line)
+        if NOPROCESS_END_REGEX.search(line):
             process = True
         retval.append(line)
     return u'\n'.join(retval)
 
 
-def process(wiki_page, space, nuclear=False, override_title=None):
-    """Processes a wiki page, getting all metadata and reformatting body"""
-    # Get again, to get attachments:
-    wiki_page = wiki_page.refresh(include='attachments')
-    # process title
-    title = override_title or wiki_page.title
-    title = title.replace('_', ' ')
-    # process body
-    body = wiki_page.text
-    if nuclear:
-        ## HTMLEncode ALL tags
-        body = body.replace('<', '&lt;')
-        # HTMLDecode redmine tags
-        body = body.replace('&lt;code>', '<code>').replace('&lt;/code>', '</code>')
-        body = body.replace('&lt;notextile>', '<notextile>').replace('&lt;/notextile>', '</notextile>')
-        body = body.replace('&lt;pre>', '<pre>').replace('&lt;/pre>', '</pre>')
+def is_well_formed(body):
+    """Checks locally whether Confluence will be able to parse the body"""
+    parser = expat.ParserCreate()
+    try:
+        parser.Parse(XML_PROLOG, False)
+        parser.Parse(body.encode('utf8'), False)
+        parser.Parse('</storage>', True)
+    except expat.ExpatError:
+        return False
+    return True
+
+
+def attachment_names(attachments):
+    """Returns the names to upload a page's attachments under, by attachment
+    id. Redmine allows several attachments with the same name; in Confluence
+    they have to be renamed.
+    """
+    names = {}
+    for attachment in attachments:
+        name = attachment.filename
+        while name in names.values():
+            name = rename_duplicate(name)
+        names[attachment.id] = name
+    return names
 
-    body = convert_links(body, space)
+
+def image_names(attachments):
+    """Maps filenames used by images in redmine markup to the Confluence
+    attachments they refer to. As in redmine, the newest attachment wins.
+    """
+    names = attachment_names(attachments)
+    return dict((attachment.filename, attachment_filename(names[attachment.id]))
+                for attachment in attachments)
+
+
+def attachment_image(src, images):
+    """Returns the Confluence name of the attachment an image's `src`
+    refers to, or None if it isn't one of `images`
+    """
+    if '/' in src:
+        return None
+    src = urllib.unquote(HTMLParser().unescape(src).encode('utf8'))
+    return images.get(src.decode('utf8'))
+
+
+def rewrite_images(soup, images):
+    """Turns images of attachments into Confluence attachment references"""
+    for img in soup.find_all('img', src=True):
+        name = attachment_image(img['src'], images)
+        if name is not None:
+            image = soup.new_tag('ac:image')
+            image.append(soup.new_tag('ri:attachment', **{'ri:filename': name}))
+            img.replace_with(image)
+
+
+def convert_body(body, title, nuclear=False, images=None):
+    """Converts a link-converted textile body to storage format html.
+    Results are kept in the conversion cache if there is one.
+    """
+    key = None
+    if CONVERSION_CACHE:
+        key = CONVERSION_CACHE.key(
+            body, title, nuclear, images, CONVERTER_VERSION,
+            pypandoc.get_pandoc_version(), textile.__version__)
+        cached = CONVERSION_CACHE.get(key)
+        if cached is not None:
+            return cached
+
+    if nuclear:
+        ## HTMLEncode ALL tags, except redmine's and the links we generated
+        body = NUCLEAR_REGEX.sub('&lt;', body)
 
     if body.startswith('h1. %s' % title):
         # strip extra repeated title from within body text
         body = body[len('h1. %s' % title):]
 
-    body = convert_textile(body)
+    with METRICS.time('convert_textile', len(body)):
+        body = convert_textile(body)
 
     if not nuclear:
-        xml_fixer = XMLFixer()
-        body = xml_fixer.fix_tags(body)
+        with METRICS.time('XMLFixer', len(body)):
+            xml_fixer = XMLFixer(images)
+            body = xml_fixer.fix_tags(body)
     else:
         # Use beautifulsoup to clean up stuff like <p><pre>xyz</p></pre>
-        body = unicode(BeautifulSoup(body))
+        with METRICS.time('nuclear cleanup', len(body)):
+            soup = BeautifulSoup(body, 'html.parser')
+            if images:
+                rewrite_images(soup, images)
+            body = unicode(soup)
+    if key:
+        CONVERSION_CACHE.put(key, body)
+    return body
 
-    return {
-        'title': title,
-        'body': body,
-        'username': wiki_page.author.refresh().login,
-        'display_name': wiki_page.author.name
-    }
+
+def convert_page(source, title, images=None):
+    """Converts a wiki page's link-converted textile to storage format. If
+    the result isn't well-formed, the nuclear option is taken straight away.
+    """
+    body = convert_body(source, title, images=images)
+    nuclear = not is_well_formed(body)
+    if nuclear:
+        body = convert_body(source, title, nuclear=True, images=images)
+    return {'body': body, 'source': source, 'nuclear': nuclear}
+
+
+def convert_pages(pages):
+    """Converts several pages at once, given as convert_page's arguments.
+    The pages are converted by concurrent threads, so that PANDOC converts
+    their bodies in a single pandoc invocation.
+    """
+    pool = ThreadPool(len(pages))
+    try:
+        return pool.map(lambda args: convert_page(*args), pages)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def fallback_body(text):
+    """Storage format of a page which couldn't be converted"""
+    return u'<pre>%s</pre>' % text.replace('&', '&amp;').replace(
+        '<', '&lt;').replace('>', '&gt;')
+
+
+def measured(func, *args):
+    """Calls `func` in a conversion worker, also returning the stage metrics
+    to be merged into those of the main process
+    """
+    return func(*args), METRICS.take()
+
+
+def run_conversion(func, *args, **kwargs):
+    """Calls the conversion function `func` in the conversion pool if there
+    is one. Raises ConversionFailed if it ran out of time or memory.
+    A call converting several `pages` is given the timeout of each.
+    """
+    pages = kwargs.pop('pages', 1)
+    if CONVERTER is None:
+        return func(*args)
+    timeout = CONVERTER.timeout and CONVERTER.timeout * pages
+    result, stages = CONVERTER.convert(measured, func, *args, timeout=timeout)
+    METRICS.merge(stages)
+    return result
 
 
-def add_page(wiki_page, proj_name, space, override_title=None):
-    """Adds page to confluence"""
-    processed = process(wiki_page, space, override_title=override_title)
+def convert(wiki_page, proj_name, func, *args):
+    """Calls the conversion function `func` in the conversion pool if there
+    is one. Returns None if it ran out of time or memory.
+    """
     try:
-        page = confluence.create_page(
-            processed['title'], processed['body'], space,
-            processed['username'], processed['display_name'])
-    except InvalidXML:
+        return run_conversion(func, *args)
+    except ConversionFailed as e:
+        log.warn(u'Converting {0} failed: {1}. Keeping it as preformatted '
+                 u'text'.format(wiki_page.title, e))
+        with STATS_LOCK:
+            STATS[proj_name]['conversion fallback'].append(wiki_page.title)
+        return None
+
+
+def page_source(wiki_page, proj_name, space):
+    """Returns a fetched page's text with its links converted. This is done
+    in the main process, where the link index is.
+    """
+    with METRICS.time('convert_links', len(wiki_page.text)):
+        return convert_links(wiki_page.text, space, proj_name)
+
+
+def or_fallback(wiki_page, source, converted):
+    """Keeps a page as preformatted text if its conversion failed"""
+    if converted is None:
+        return {'body': fallback_body(wiki_page.text),
+                'source': source, 'nuclear': False}
+    return converted
+
+
+def convert_text(wiki_page, proj_name, space, title, images=None):
+    """Converts the text of a fetched page, as preformatted text if the
+    conversion runs out of time or memory. Pages submitted to PRECONVERTER
+    are taken from it.
+    """
+    converted = PRECONVERTER.take(wiki_page, proj_name, space, title, images)
+    if converted is None:
+        source = page_source(wiki_page, proj_name, space)
+        converted = or_fallback(wiki_page, source, convert(
+            wiki_page, proj_name, convert_page, source, title, images))
+    return converted
+
+
+def process(wiki_page, proj_name, space, override_title=None):
+    """Processes a fetched wiki page, getting all metadata and reformatting
+    body
+    """
+    # process title
+    title = override_title or wiki_page.title
+    title = title.replace('_', ' ')
+    # process body
+    if isinstance(wiki_page, ExportedPage):
+        # converted by --export already
+        converted = wiki_page.converted
+        images = wiki_page.meta['images']
+        username = wiki_page.meta['username']
+        display_name = wiki_page.meta['display_name']
+    else:
+        images = image_names(wiki_page.attachments)
+        converted = convert_text(wiki_page, proj_name, space, title, images)
+        username, display_name = users.lookup(wiki_page.author)
+    return dict(converted, **{
+        'title': title,
+        'images': images,
+        'username': username,
+        'display_name': display_name
+    })
+
+
+def add_page(wiki_page, proj_name, space, override_title=None, page_id=None,
+             parent_id=None):
+    """Adds page to confluence, or updates the existing page `page_id`"""
+    def save(processed):
+        if page_id:
+            with METRICS.time('update_page', len(processed['body'])):
+                return confluence.update_page(page_id, processed['body'])
+        with METRICS.time('create_page', len(processed['body'])):
+            return confluence.create_page(
+                processed['title'], processed['body'], space,
+                processed['username'], processed['display_name'],
+                parent_id=parent_id)
+
+    processed = process(wiki_page, proj_name, space,
+                        override_title=override_title)
+    if processed['nuclear']:
         log.warn('Invalid XML generated. Going for the nuclear option...')
+    else:
+        try:
+            return save(processed)
+        except InvalidXML:
+            log.warn('Confluence rejected XML. Going for the nuclear option...')
+            processed['body'] = convert(
+                wiki_page, proj_name, convert_body, processed['source'],
+                processed['title'], True, processed['images'])
+            if processed['body'] is None:
+                processed['body'] = fallback_body(processed['source'])
+    with STATS_LOCK:
         STATS[proj_name]['nuclear'].append(wiki_page.title)
-        processed = process(
-            wiki_page, space, nuclear=True, override_title=override_title)
-        page = confluence.create_page(
-            processed['title'], processed['body'], space,
-            processed['username'], processed['display_name'])
-    return page
-
-
-def fix_img_tags(page_id):
-    page = confluence.get_page(page_id)
-    soup = BeautifulSoup(page['body']['view']['value'])
-    changed = False
-    for img in soup.find_all('img'):
-        if '/' not in img['src']:
-            img['src'] = '/download/attachments/%s/%s' % (
-                page_id, urllib.quote_plus(img['src'].encode('utf8')))
-            changed = True
+    return save(processed)
+
+
+def parent_title(wiki_page):
+    try:
+        return wiki_page.parent['title']
+    except ResourceAttrError:
+        return None
+
+
+def hierarchy_order(wiki_pages):
+    """Orders wiki pages so that every page comes after its parent"""
+    titles = set(wiki_page.title for wiki_page in wiki_pages)
+    children = {}
+    queue = deque()
+    for wiki_page in wiki_pages:
+        parent = parent_title(wiki_page)
+        if parent in titles:
+            children.setdefault(parent, []).append(wiki_page)
+        else:
+            queue.append(wiki_page)
+    retval = []
+    while queue:
+        wiki_page = queue.popleft()
+        retval.append(wiki_page)
+        queue.extend(children.pop(wiki_page.title, []))
+    # only pages whose parents form a loop are left
+    for pages in children.itervalues():
+        retval.extend(pages)
+    return retval
+
+
+class TitleIndex(object):
+    """The page titles taken in a Confluence space, so that duplicate titles
+    can be renamed before trying to create the page.
+    """
+    def __init__(self, titles):
+        self.titles = set(self.normalize(title) for title in titles)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize(title):
+        # Confluence titles are unique regardless of case
+        return title.replace('_', ' ').lower()
+
+    def claim(self, title):
+        """Reserves the title, returns False if it's already taken"""
+        title = self.normalize(title)
+        with self.lock:
+            if title in self.titles:
+                return False
+            self.titles.add(title)
+            return True
+
+
+class CreatedPages(object):
+    """The pages of a project imported so far, by redmine title.
+    Lets a page being imported wait until its parent has been imported.
+    `wiki_pages` is the order in which the pages will be imported.
+    """
+    def __init__(self, wiki_pages):
+        self.pages = {}
+        self.events = {}
+        self.positions = {}
+        for position, wiki_page in enumerate(wiki_pages):
+            self.events[wiki_page.title] = threading.Event()
+            self.positions[wiki_page.title] = position
+
+    def add(self, title, page):
+        self.pages[title] = page
+
+    def done(self, title):
+        self.events[title].set()
+
+    def get(self, title, child):
+        """Returns the imported page `title` for its child page `child`,
+        waiting for it if it isn't done yet
+        """
+        if self.positions.get(title, len(self.positions)) < self.positions[child]:
+            self.events[title].wait()
+        return self.pages.get(title)
+
+
+class Prefetcher(threading.Thread):
+    """Fetches wiki pages from redmine ahead of the threads importing them.
+    At most `depth` fetched pages wait in the queue, and pages come out of
+    it in the order they were passed in.
+    """
+    def __init__(self, wiki_pages, fetch, depth=10):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.wiki_pages = wiki_pages
+        self.fetch = fetch
+        self.queue = Queue.Queue(maxsize=depth)
+
+    def run(self):
+        for wiki_page in self.wiki_pages:
+            try:
+                wiki_page = self.fetch(wiki_page)
+            except Exception as e:
+                # leave it to the importer to fail and record it
+                log.error(u'Could not fetch {0}: {1}'.format(wiki_page.title, e))
+            self.queue.put(wiki_page)
+        self.queue.put(None)
+
+    def get(self):
+        """Returns the next fetched page, or None once all have been taken"""
+        wiki_page = self.queue.get()
+        if wiki_page is None:
+            # let the other consumers know too
+            self.queue.put(None)
+        return wiki_page
+
+
+class Preconverter(object):
+    """Converts fetched pages ahead of the threads importing them.
+    There is a thread per process of the conversion pool (one if converting
+    in-line). Each takes the pages submitted while it was busy, up to
+    `batch_size`, and converts them in a single call, so that all processes
+    have work and each batch goes to pandoc in one invocation. Pages are
+    taken out again by convert_text().
+    A batch holds at most `batch_chars` characters of source, so that it
+    fits the memory limit of a single page; larger pages are converted alone.
+    """
+    def __init__(self, batch_size=10, batch_chars=64 * 1024):
+        self.batch_size = batch_size
+        self.batch_chars = batch_chars
+        self.queue = Queue.Queue()
+        self.pending = {}
+        self.threads = []
+        self.converter = None
+        self.lock = threading.Lock()
+        atexit.register(self.stop)
+
+    def submit(self, wiki_page, proj_name, space, title, images=None):
+        """Starts converting a fetched page, as convert_text() would"""
+        job = {
+            'wiki_page': wiki_page,
+            'proj_name': proj_name,
+            'args': (space, title, images),
+            'done': threading.Event()
+        }
+        with self.lock:
+            if not self.threads or self.converter is not CONVERTER:
+                self._stop()
+                self.converter = CONVERTER
+                for _ in range(CONVERTER.processes if CONVERTER else 1):
+                    thread = threading.Thread(target=self.run)
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+            self.pending[(proj_name, wiki_page.title)] = job
+            self.queue.put(job)
+
+    def take(self, wiki_page, proj_name, space, title, images=None):
+        """Returns the conversion of a submitted page, waiting for it, or
+        None if the page wasn't submitted with these arguments
+        """
+        with self.lock:
+            job = self.pending.pop((proj_name, wiki_page.title), None)
+        if job is None or job['args'] != (space, title, images):
+            return None
+        job['done'].wait()
+        if 'error' in job:
+            raise job['error']
+        return job['result']
+
+    def discard(self, proj_name, title):
+        """Forgets a submitted page which won't be taken"""
+        with self.lock:
+            self.pending.pop((proj_name, title), None)
+
+    def stop(self):
+        with self.lock:
+            self._stop()
+
+    def _stop(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if None in batch:
+                # stop() was called; there's one None for each thread
+                stopped = True
+                for _ in range(batch.count(None) - 1):
+                    self.queue.put(None)
+                batch = [job for job in batch if job is not None]
+            by_project = {}
+            for job in batch:
+                by_project.setdefault(job['proj_name'], []).append(job)
+            for proj_name, jobs in by_project.iteritems():
+                with METRICS.project(proj_name):
+                    self.convert(jobs)
+
+    def batches(self, jobs):
+        """Splits jobs into batches of at most `batch_chars` of source"""
+        batches = []
+        chars = 0
+        for job in jobs:
+            if not batches or chars + len(job['source']) > self.batch_chars:
+                batches.append([])
+                chars = 0
+            batches[-1].append(job)
+            chars += len(job['source'])
+        return batches
+
+    def convert(self, jobs):
+        for job in jobs:
+            try:
+                job['source'] = page_source(
+                    job['wiki_page'], job['proj_name'], job['args'][0])
+            except Exception as e:
+                job['error'] = e
+                job['done'].set()
+        jobs = [job for job in jobs if 'error' not in job]
+        for batch in self.batches(jobs):
+            self.convert_batch(batch)
+
+    def convert_batch(self, jobs):
+        results = None
+        if len(jobs) > 1:
+            try:
+                results = run_conversion(convert_pages, [
+                    (job['source'],) + job['args'][1:] for job in jobs],
+                    pages=len(jobs))
+            except Exception:
+                # one of them may be too big or broken; find out which
+                log.warn(u'Converting {0} pages together failed, converting '
+                         u'them one by one'.format(len(jobs)))
+        for idx, job in enumerate(jobs):
+            try:
+                if results:
+                    converted = results[idx]
+                else:
+                    converted = convert(
+                        job['wiki_page'], job['proj_name'], convert_page,
+                        job['source'], *job['args'][1:])
+                job['result'] = or_fallback(
+                    job['wiki_page'], job['source'], converted)
+            except Exception as e:
+                job['error'] = e
+            job['done'].set()
+
+
+PRECONVERTER = Preconverter()
+
+
+def fetch_page(wiki_page):
+    """Gets the full wiki page: text, attachments, parent and author"""
+    with METRICS.time('redmine fetch'):
+        wiki_page = wiki_page.refresh(include='attachments')
+    users.lookup(wiki_page.author)
+    return wiki_page
+
+
+def download_attachment(attachment):
+    """Downloads a redmine attachment chunk by chunk into a temporary file,
+    or into the attachment cache if there is one. Returns the open file.
+    """
+    try:
+        checksum = attachment.digest
+    except ResourceAttrError:
+        # only reported by newer redmines
+        checksum = None
+    if ATTACHMENT_CACHE:
+        data = ATTACHMENT_CACHE.get(attachment.id, checksum)
+        if data:
+            return data
+    res = redmine.limiter.call(lambda: requests.get(
+        u'{0}?key={1}'.format(attachment.content_url, REDMINE['key']),
+        stream=True, hooks={'response': redmine.limiter.observe}))
+    res.raise_for_status()
+    if ATTACHMENT_CACHE:
+        return ATTACHMENT_CACHE.put(
+            attachment.id, res.iter_content(CHUNK_SIZE), checksum)
+    data = tempfile.TemporaryFile()
+    for chunk in res.iter_content(CHUNK_SIZE):
+        data.write(chunk)
+    data.seek(0)
+    return data
+
+
+def add_attachments(wiki_page, proj_name, page_id, max_attachment_size=None):
+    """Uploads the page's attachments which haven't been uploaded yet.
+    Returns the number of attachments uploaded.
+    """
+    added = journal.attachments_added(proj_name, wiki_page.title)
+    names = attachment_names(wiki_page.attachments)
+    count = 0
+    for attachment in wiki_page.attachments:
+        if attachment.id in added:
+            continue
+        if max_attachment_size and attachment.filesize > max_attachment_size:
+            log.warn(u'Skipping attachment: {0} ({1} bytes)'.format(
+                attachment.filename, attachment.filesize))
+            with STATS_LOCK:
+                STATS[proj_name]['skipped attachments'].append(
+                    u'{0}: {1}'.format(wiki_page.title, attachment.filename))
+            continue
+        log.info(u'Adding attachment: {0} ({1} bytes)'.format(
+            attachment.filename, attachment.filesize))
+        with METRICS.time('attachment download', attachment.filesize):
+            data = download_attachment(attachment)
+        try:
+            with METRICS.time('attachment upload', attachment.filesize):
+                res = confluence.add_attachment(
+                    page_id, names[attachment.id], data, attachment.description)
+        finally:
+            data.close()
+        stored_as = res.get('results', [{}])[0].get('title')
+        if stored_as and stored_as != attachment_filename(names[attachment.id]):
+            log.warn(u'Attachment {0} stored as {1}, images of it will be '
+                     u'broken'.format(attachment.filename, stored_as))
+        journal.attachment_added(
+            proj_name, wiki_page.title, attachment.id, attachment.filename)
+        count += 1
+    return count
+
+
+def page_changed(entry, wiki_page):
+    """Whether a fetched page changed since its journal entry was written"""
+    return (entry['version'] != wiki_page.version or
+            entry['updated_on'] != str(wiki_page.updated_on))
+
+
+def sync_page(wiki_page, proj_name, space, entry, max_attachment_size=None):
+    """Brings an already imported page up to date with redmine.
+    The page body is only rewritten if the redmine page has a new version,
+    and only attachments added since the last run are uploaded.
+    """
+    changed = page_changed(entry, wiki_page)
     if changed:
-        confluence.update_page(page_id, unicode(soup))
+        log.info(u"Updating: {0}".format(wiki_page.title))
+        add_page(wiki_page, proj_name, space,
+                 override_title=entry['confluence_title'],
+                 page_id=entry['confluence_id'])
+        journal.page_updated(proj_name, wiki_page.title, wiki_page.version,
+                             str(wiki_page.updated_on))
+    added = add_attachments(
+        wiki_page, proj_name, entry['confluence_id'], max_attachment_size)
+    if changed or added:
+        with STATS_LOCK:
+            STATS[proj_name]['updated'].append(wiki_page.title)
+
+
+def rename_page(wiki_page, proj_name, titles):
+    """Picks the title for a page whose title is taken in the space"""
+    title = '%s_-_%s' % (proj_name, wiki_page.title)
+    suffix = 1
+    # the prefixed title may be taken as well, e.g. by an earlier migration
+    while not titles.claim(title):
+        suffix += 1
+        title = '%s_-_%s_(%d)' % (proj_name, wiki_page.title, suffix)
+    with STATS_LOCK:
+        STATS[proj_name]['renamed'][wiki_page.title] = title
+    return title
+
 
+def planned_title(wiki_page, proj_name):
+    """Returns the title plan_titles decided on for a page"""
+    planned = LINK_INDEX.get(proj_name, wiki_page.title)
+    return planned['title'] if planned else wiki_page.title
 
-def main():
+
+def conversion_title(wiki_page, proj_name, sync=False):
+    """Returns the title under which import_page will convert a fetched
+    page, or None if it won't convert it
+    """
+    if isinstance(wiki_page, ExportedPage):
+        # converted by --export already
+        return None
+    entry = journal.get_page(proj_name, wiki_page.title)
+    if entry is None:
+        return planned_title(wiki_page, proj_name)
+    if (entry['status'] == 'complete' and sync and
+            page_changed(entry, wiki_page)):
+        return entry['confluence_title']
+    return None
+
+
+def import_page(wiki_page, proj_name, space, created_pages, titles,
+                max_attachment_size=None, sync=False):
+    """Imports a single wiki page along with its attachments, beneath its
+    already imported parent.
+    """
+    with METRICS.project(proj_name), METRICS.time('page'):
+        _import_page(wiki_page, proj_name, space, created_pages, titles,
+                     max_attachment_size, sync)
+
+
+def _import_page(wiki_page, proj_name, space, created_pages, titles,
+                 max_attachment_size=None, sync=False):
+    entry = journal.get_page(proj_name, wiki_page.title)
+    if entry and entry['status'] == 'complete':
+        created_pages.add(wiki_page.title, {
+            'id': entry['confluence_id'],
+            'title': entry['confluence_title']
+        })
+        if not sync:
+            log.info(u"Already imported: {0}".format(wiki_page.title))
+            created_pages.done(wiki_page.title)
+            return
+    with STATS_LOCK:
+        if wiki_page.title in STATS[proj_name]['failed import']:
+            # retrying a page which failed in an earlier run
+            STATS[proj_name]['failed import'].remove(wiki_page.title)
+    try:
+        if entry and entry['status'] == 'complete':
+            sync_page(wiki_page, proj_name, space, entry, max_attachment_size)
+            return
+        if entry:
+            log.info(u"Resuming: {0}".format(wiki_page.title))
+            title = entry['confluence_title']
+            page = {'id': entry['confluence_id']}
+        else:
+            log.info(u"Importing: {0}".format(wiki_page.title))
+            parent = parent_title(wiki_page)
+            parent_id = None
+            if parent not in [None, 'Wiki']:
+                parent_page = created_pages.get(parent, wiki_page.title)
+                if parent_page:
+                    parent_id = parent_page['id']
+                else:
+                    with STATS_LOCK:
+                        STATS[proj_name]['failed hierarchical move'].append(
+                            wiki_page.title)
+            title = planned_title(wiki_page, proj_name)
+            try:
+                page = add_page(wiki_page, proj_name, space,
+                                override_title=title, parent_id=parent_id)
+            except DuplicateWikiPage:
+                if title != wiki_page.title:
+                    raise
+                # page was created by someone else after the titles were loaded
+                title = rename_page(wiki_page, proj_name, titles)
+                LINK_INDEX.add(proj_name, wiki_page.title, space, title)
+                page = add_page(wiki_page, proj_name, space,
+                                override_title=title, parent_id=parent_id)
+            journal.page_created(
+                proj_name, wiki_page.title, title, page['id'], parent,
+                wiki_page.version, str(wiki_page.updated_on))
+            LINK_INDEX.add(proj_name, wiki_page.title, space, title, page['id'])
+        created_pages.add(wiki_page.title, {'id': page['id'], 'title': title})
+        add_attachments(wiki_page, proj_name, page['id'], max_attachment_size)
+        journal.set_status(proj_name, wiki_page.title, 'complete')
+    except Exception as e:
+        msg = 'Uncaught exception during import of %s! Page not imported!'
+        log.error(msg % wiki_page.title)
+        traceback.print_exc()
+        with STATS_LOCK:
+            STATS[proj_name]['failed import'].append(wiki_page.title)
+    finally:
+        PRECONVERTER.discard(proj_name, wiki_page.title)
+        created_pages.done(wiki_page.title)
+        with STATS_LOCK:
+            journal.save_stats(proj_name, STATS[proj_name])
+
+
+def init_stats(proj_name, resume=False, sync=False):
+    STATS[proj_name] = {
+        'nuclear': [],
+        'failed import': [],
+        'failed hierarchical move': [],
+        'skipped attachments': [],
+        'updated': [],
+        'conversion fallback': [],
+        'renamed': {}
+    }
+    if resume or sync:
+        STATS[proj_name].update(journal.load_stats(proj_name) or {})
+    if sync:
+        STATS[proj_name]['updated'] = []
+
+
+def get_projects():
+    """Returns (name, space, project, wiki pages) of the redmine projects to
+    migrate, skipping those which can't be accessed. The wiki pages are in
+    hierarchy order.
+    """
+    projects = []
     for proj_name, space in PROJECTS.iteritems():
-        STATS[proj_name] = {
-            'nuclear': [],
-            'failed import': [],
-            'failed hierarchical move': [],
-            'renamed': {}
-        }
-        created_pages = {}
         try:
             project = redmine.project.get(proj_name)
-            log.info(u"Importing project {0} into space {1} ({2} pages)".format(
-                proj_name, space, len(project.wiki_pages)))
+            wiki_pages = hierarchy_order(list(project.wiki_pages))
         except BaseRedmineError as e:
             log.error(u"Redmine error accessing project {0}: '{1}' Skipping!".format(
                 proj_name, e.message))
             SKIPPED_PROJECTS.append(proj_name)
             continue
-        confluence.create_space(space, project.name, project.description)
+        projects.append((proj_name, space, project, wiki_pages))
+    return projects
+
+
+def plan_titles(proj_name, space, wiki_pages, titles):
+    """Decides the Confluence title of each page of a project, renaming those
+    whose title is taken in `titles`, and adds them to the link index
+    """
+    entries = dict((entry['title'], entry) for entry in journal.pages(proj_name))
+    # pages imported by an earlier run keep their titles
+    for wiki_page in wiki_pages:
+        entry = entries.get(wiki_page.title)
+        if entry:
+            titles.claim(entry['confluence_title'])
+            LINK_INDEX.add(proj_name, wiki_page.title, space,
+                           entry['confluence_title'], entry['confluence_id'])
+    for wiki_page in wiki_pages:
+        if wiki_page.title in entries:
+            continue
+        title = wiki_page.title
+        if not titles.claim(title):
+            title = rename_page(wiki_page, proj_name, titles)
+        LINK_INDEX.add(proj_name, wiki_page.title, space, title)
+
+
+def import_project(proj_name, space, name, description, wiki_pages, titles,
+                   fetch, workers=1, max_attachment_size=None, sync=False,
+                   prefetch=10):
+    """Imports wiki pages, in hierarchy order, into a space whose titles are
+    `titles`. `fetch` gets each page in full.
+    """
+    confluence.create_space(space, name, description)
+
+    # pages are created parents first so that children can be created
+    # beneath them
+    created_pages = CreatedPages(wiki_pages)
+
+    def fetch_in_project(wiki_page):
+        with METRICS.project(proj_name):
+            wiki_page = fetch(wiki_page)
+        title = conversion_title(wiki_page, proj_name, sync)
+        if title is not None:
+            # converted while the importers wait for Confluence
+            PRECONVERTER.submit(wiki_page, proj_name, space,
+                                title.replace('_', ' '),
+                                image_names(wiki_page.attachments))
+        return wiki_page
+
+    prefetcher = Prefetcher(wiki_pages, fetch_in_project, depth=prefetch)
+    prefetcher.start()
+
+    def importer():
+        # pages are taken in order, so a page's parent has always been
+        # taken by an importer before the page itself
+        wiki_page = prefetcher.get()
+        while wiki_page is not None:
+            import_page(wiki_page, proj_name, space, created_pages, titles,
+                        max_attachment_size, sync)
+            wiki_page = prefetcher.get()
+
+    importers = [threading.Thread(target=importer) for _ in range(workers)]
+    for thread in importers:
+        thread.start()
+    for thread in importers:
+        thread.join()
+
 
-        # create pages
-        for wiki_page in project.wiki_pages:
+def main(workers=1, max_attachment_size=None, resume=False, sync=False,
+         prefetch=10):
+    if not (resume or sync):
+        journal.reset()
+    for proj_name in PROJECTS:
+        init_stats(proj_name, resume, sync)
+    projects = get_projects()
+    # decide where every page goes before converting any, so that links
+    # between projects point at the right pages
+    titles = {}
+    for proj_name, space, project, wiki_pages in projects:
+        titles[proj_name] = TitleIndex(confluence.get_titles(space))
+        plan_titles(proj_name, space, wiki_pages, titles[proj_name])
+
+    for proj_name, space, project, wiki_pages in projects:
+        log.info(u"Importing project {0} into space {1} ({2} pages)".format(
+            proj_name, space, len(wiki_pages)))
+
+        def fetch(wiki_page):
+            entry = journal.get_page(proj_name, wiki_page.title)
+            if entry and entry['status'] == 'complete' and not sync:
+                # won't be imported again
+                return wiki_page
+            return fetch_page(wiki_page)
+
+        import_project(proj_name, space, project.name, project.description,
+                       wiki_pages, titles[proj_name], fetch, workers,
+                       max_attachment_size, sync, prefetch)
+
+
+def init_converter(conversion_cache):
+    """Sets up a conversion worker process"""
+    global CONVERSION_CACHE, METRICS
+    # sqlite connections can't be shared with a forked process
+    CONVERSION_CACHE = conversion_cache and ConversionCache(conversion_cache)
+    # don't count what the main process recorded before the fork again
+    METRICS = Metrics()
+
+
+def export_meta(wiki_page):
+    """Returns the metadata of a fetched page to store in an export bundle"""
+    username, display_name = users.lookup(wiki_page.author)
+    attachments = []
+    for attachment in wiki_page.attachments:
+        try:
+            digest = attachment.digest
+        except ResourceAttrError:
+            digest = None
+        attachments.append({
+            'id': attachment.id,
+            'filename': attachment.filename,
+            'filesize': attachment.filesize,
+            'description': attachment.description,
+            'content_url': attachment.content_url,
+            'digest': digest
+        })
+    return {
+        'title': wiki_page.title,
+        'parent': parent_title(wiki_page),
+        'version': wiki_page.version,
+        'updated_on': str(wiki_page.updated_on),
+        'username': username,
+        'display_name': display_name,
+        'images': image_names(wiki_page.attachments),
+        'attachments': attachments
+    }
+
+
+def export_failed(wiki_page, proj_name):
+    """Logs the exception exporting a page and counts it as failed"""
+    msg = 'Uncaught exception during export of %s! Page not exported!'
+    log.error(msg % wiki_page.title)
+    log.error(traceback.format_exc())
+    with STATS_LOCK:
+        STATS[proj_name]['failed import'].append(wiki_page.title)
+
+
+def export(path, prefetch=10):
+    """Converts every project into an export bundle in `path`, without
+    touching Confluence
+    """
+    for proj_name in PROJECTS:
+        init_stats(proj_name)
+    projects = get_projects()
+    for proj_name, space, project, wiki_pages in projects:
+        # Confluence isn't asked, so only clashes within a project are known
+        plan_titles(proj_name, space, wiki_pages, TitleIndex([]))
+
+    for proj_name, space, project, wiki_pages in projects:
+        log.info(u"Exporting project {0} ({1} pages)".format(
+            proj_name, len(wiki_pages)))
+        writer = BundleWriter(
+            path, proj_name, space, project.name, project.description)
+        def fetch_in_project(wiki_page):
+            with METRICS.project(proj_name):
+                return fetch_page(wiki_page)
+
+        prefetcher = Prefetcher(wiki_pages, fetch_in_project, depth=prefetch)
+        prefetcher.start()
+
+        def write(wiki_page, meta, title):
             try:
-                log.info(u"Importing: {0}".format(wiki_page.title))
-                new_title = None
-                try:
-                    page = add_page(wiki_page, proj_name, space)
-                except DuplicateWikiPage:
-                    new_title = '%s_-_%s' % (proj_name, wiki_page.title)
-                    STATS[proj_name]['renamed'][wiki_page.title] = new_title
-                    page = add_page(
-                        wiki_page, proj_name, space, override_title=new_title)
+                with METRICS.project(proj_name):
+                    converted = convert_text(
+                        wiki_page, proj_name, space, title, meta['images'])
+            except Exception:
+                export_failed(wiki_page, proj_name)
+                return
+            if converted['nuclear']:
+                with STATS_LOCK:
+                    STATS[proj_name]['nuclear'].append(wiki_page.title)
+            meta['nuclear'] = converted['nuclear']
+            writer.add_page(meta, converted['body'], converted['source'])
 
-                try:
-                    parent = wiki_page.parent['title']
-                except ResourceAttrError:
-                    parent = None
-                created_pages[new_title or wiki_page.title] = {
-                    'id': page['id'],
-                    'parent': parent
-                }
-                for attachment in wiki_page.attachments:
-                    log.info(u'Adding attachment: {0} ({1} bytes)'.format(
-                        attachment.filename, attachment.filesize))
-                    data = requests.get(
-                        u'{0}?key={1}'.format(attachment.content_url, REDMINE['key']),
-                        stream=True).raw.read()
-                    confluence.add_attachment(
-                        page['id'], attachment.filename, data, attachment.description)
-                if wiki_page.attachments:
-                    fix_img_tags(page['id'])
-            except Exception as e:
-                msg = 'Uncaught exception during import of %s! Page not imported!'
-                log.error(msg % wiki_page.title)
-                traceback.print_exc()
-                STATS[proj_name]['failed import'].append(wiki_page.title)
-
-        # organize pages hierarchically
-        for title, created_page in created_pages.iteritems():
-            if created_page.get('parent'):
-                parent = STATS[proj_name]['renamed'].get(created_page['parent'],
-                                                         created_page['parent'])
-                if parent in [None, 'Wiki']:
-                    continue
-                log.info(u'Moving "{0}" beneath "{1}"'.format(title, parent))
-                try:
-                    confluence.move_page(created_page['id'],
-                                         created_pages[parent]['id'])
-                except Exception as e:
-                    msg = 'Uncaught exception during hierarchical move of %s!'
-                    log.error(msg % title)
-                    traceback.print_exc()
-                    STATS[proj_name]['failed hierarchical move'].append(title)
+        # pages are written in the order they were fetched, i.e. parents first
+        pending = deque()
+        wiki_page = prefetcher.get()
+        while wiki_page is not None:
+            log.info(u"Converting: {0}".format(wiki_page.title))
+            try:
+                meta = export_meta(wiki_page)
+                title = wiki_page.title.replace('_', ' ')
+                PRECONVERTER.submit(wiki_page, proj_name, space, title,
+                                    meta['images'])
+            except Exception:
+                export_failed(wiki_page, proj_name)
+            else:
+                pending.append((wiki_page, meta, title))
+            while len(pending) > prefetch:
+                write(*pending.popleft())
+            wiki_page = prefetcher.get()
+        while pending:
+            write(*pending.popleft())
+        writer.close()
+
+
+def upload(path, workers=1, max_attachment_size=None, resume=False,
+           sync=False, prefetch=10):
+    """Imports the projects of an export bundle into Confluence"""
+    if not (resume or sync):
+        journal.reset()
+    projects = read_bundle(path)
+    titles = {}
+    for project in projects:
+        init_stats(project['project'], resume, sync)
+        project['pages'] = hierarchy_order(project['pages'])
+        titles[project['project']] = TitleIndex(
+            confluence.get_titles(project['space']))
+        plan_titles(project['project'], project['space'], project['pages'],
+                    titles[project['project']])
+
+    for project in projects:
+        log.info(u"Uploading project {0} into space {1} ({2} pages)".format(
+            project['project'], project['space'], len(project['pages'])))
+        import_project(project['project'], project['space'], project['name'],
+                       project['description'], project['pages'],
+                       titles[project['project']],
+                       lambda wiki_page: wiki_page.load(), workers,
+                       max_attachment_size, sync, prefetch)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Import redmine wikis into Confluence')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of pages to import concurrently')
+    parser.add_argument('--export', metavar='DIR',
+                        help='Only convert the wikis, into a bundle in DIR')
+    parser.add_argument('--upload', metavar='DIR',
+                        help='Import a bundle made by --export')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Number of processes converting pages '
+                             '(default: one per cpu, 0: convert in-line)')
+    parser.add_argument('--conversion-timeout', type=float, default=300,
+                        metavar='SECONDS',
+                        help='Keep pages taking longer to convert as '
+                             'preformatted text')
+    parser.add_argument('--conversion-memory', type=int, default=2048,
+                        metavar='MB',
+                        help='Keep pages needing more memory to convert as '
+                             'preformatted text')
+    parser.add_argument('--max-attachment-size', type=int, default=None,
+                        metavar='MB', help='Skip attachments larger than this')
+    parser.add_argument('--journal', default='journal.sqlite',
+                        help='File in which migration progress is recorded')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted migration')
+    parser.add_argument('--sync', action='store_true',
+                        help='Update pages changed since the last run')
+    parser.add_argument('--attachment-cache', metavar='DIR',
+                        help='Keep downloaded attachments in this directory')
+    parser.add_argument('--attachment-cache-size', type=int, default=10240,
+                        metavar='MB', help='Maximum size of the attachment cache')
+    parser.add_argument('--conversion-cache', metavar='FILE',
+                        help='Keep converted page bodies in this file')
+    parser.add_argument('--prefetch', type=int, default=10,
+                        help='Number of pages to fetch from redmine ahead')
+    parser.add_argument('--prometheus', metavar='FILE',
+                        help='Also write the timing statistics to FILE, in '
+                             'the Prometheus text format')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Maximum requests per second to redmine and '
+                             'Confluence together (default: unlimited)')
+    args = parser.parse_args()
+    if args.rate is not None and args.rate <= 0:
+        parser.error('--rate must be positive')
+
+    limiter = RateLimiter(args.rate)
     confluence = Confluence(CONFLUENCE['url'], CONFLUENCE['username'],
-                        CONFLUENCE['password'], verify_ssl=VERIFY_SSL)
-    redmine = Redmine(REDMINE['url'], key=REDMINE['key'])
-    main()
+                        CONFLUENCE['password'], verify_ssl=VERIFY_SSL,
+                        pool_size=max(args.workers, 10), limiter=limiter)
+    redmine = ThrottledRedmine(REDMINE['url'], limiter, key=REDMINE['key'])
+    users = UserCache(redmine)
+    users.prefetch()
+    journal = Journal(args.journal)
+    if args.conversion_cache:
+        CONVERSION_CACHE = ConversionCache(args.conversion_cache)
+    if args.attachment_cache:
+        ATTACHMENT_CACHE = AttachmentCache(
+            args.attachment_cache, args.attachment_cache_size * 1024 * 1024)
+    if args.processes != 0:
+        # started before any other threads, as the workers are forked
+        CONVERTER = ConversionPool(
+            args.processes, timeout=args.conversion_timeout,
+            memory_limit=args.conversion_memory * 1024 * 1024,
+            initializer=init_converter,
+            initargs=(CONVERSION_CACHE and CONVERSION_CACHE.path,))
+    max_attachment_size = None
+    if args.max_attachment_size:
+        max_attachment_size = args.max_attachment_size * 1024 * 1024
+    if args.export:
+        export(args.export, prefetch=args.prefetch)
+    elif args.upload:
+        upload(args.upload, workers=args.workers,
+               max_attachment_size=max_attachment_size, resume=args.resume,
+               sync=args.sync, prefetch=args.prefetch)
+    else:
+        main(workers=args.workers, max_attachment_size=max_attachment_size,
+             resume=args.resume, sync=args.sync, prefetch=args.prefetch)
     log.info('====================')
     log.info('Statistics:')
     log.info('====================')
@@ -312,5 +1430,21 @@ if __name__ == '__main__':
         for orig_title, new_title in STATS[proj_name]['renamed'].iteritems():
             log.info('    %s ===> %s' % (orig_title, new_title))
         log.info('====================')
+    log.info('Rate limiter:')
+    for counter, value in sorted(limiter.stats().iteritems()):
+        log.info('    %s: %s' % (counter, value))
+    timing = METRICS.report()
+    log.info('Time per stage:')
+    for stage, entry in sorted(timing.get('total', {}).iteritems()):
+        log.info('    %s: %.1fs (%d calls, %d bytes)' % (
+            stage, entry['seconds'], entry['count'], entry['bytes']))
     with open('statistics.json', 'w') as f:
-        f.write(json.dumps(STATS, indent=4))
+        f.write(json.dumps(dict(STATS, **{
+            'rate limiter': limiter.stats(),
+            'timing': timing
+        }), indent=4))
+    if args.prometheus:
+        with open(args.prometheus, 'w') as f:
+            f.write(METRICS.prometheus(dict(
+                ('rate_limiter_%s' % counter, value)
+                for counter, value in limiter.stats().iteritems())))
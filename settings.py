@@ -0,0 +1,5 @@
+REDMINE = {'url': 'http://redmine/redmine', 'key': 'k'}
+CONFLUENCE = {'url': 'http://confluence:8090', 'username': 'u', 'password': 'p'}
+JIRA_URL = 'http://sysrenov1:8080'
+VERIFY_SSL = True
+PROJECTS = {'nbrsf': 'NBR'}
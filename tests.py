@@ -1,6 +1,26 @@
+import io
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
-from redmine2confluence import convert_links
+from redmine.exceptions import ResourceAttrError
+
+from benchmark import generate_corpus
+from bundle import BundleWriter, ExportedPage, read_bundle
+from cache import AttachmentCache, ConversionCache
+from confluence import Confluence, MultipartBody
+import converter
+from converter import ConversionFailed, ConversionPool
+from journal import Journal
+from metrics import Metrics
+from ratelimit import RateLimiter, Throttled
+import redmine2confluence as r2c
+from redmine2confluence import (convert_links, convert_textile,
+                                hierarchy_order, LINK_INDEX, TitleIndex,
+                                XMLFixer)
 from settings import CONFLUENCE, PROJECTS
 
 
@@ -115,3 +135,792 @@ class TestLinkConversion(unittest.TestCase):
         html = '<a href="%s">%s</a>' % (url, url)
         expected = '\n'.join([html for _ in range(4)])
         self.assertTrue(convert_links(text, 'nbrsf'), expected)
+
+    def test_make_url_clickable_url_prefix(self):
+        """Should link each url whole when one url is a prefix of another"""
+        text = 'http://bla.com/page and http://bla.com'
+        expected = ('<a href="http://bla.com/page">http://bla.com/page</a> and '
+                    '<a href="http://bla.com">http://bla.com</a>')
+        self.assertEqual(convert_links(text, self.space), expected)
+
+    def test_redmine_link_translation_single(self):
+        """Should re-write a hard-coded redmine link to its Confluence page"""
+        text = 'See http://redmine/redmine/projects/nbrsf/wiki/API_Integration_Test/'
+        url = '%s/display/%s/%s' % (CONFLUENCE['url'], PROJECTS['nbrsf'], 'API+Integration+Test')
+        expected = 'See <a href="%s">%s</a>' % (url, url)
+        self.assertEqual(convert_links(text, 'nbrsf'), expected)
+
+
+class TestLinkIndex(unittest.TestCase):
+    def setUp(self):
+        LINK_INDEX.add('nbrsf', 'API_Integration_Test', 'NBR',
+                       'nbrsf_-_API_Integration_Test')
+
+    def tearDown(self):
+        LINK_INDEX.pages.clear()
+
+    def test_renamed_page(self):
+        """Should link to the title a page was renamed to"""
+        text = '[[API Integration Test]]'
+        expected = ('<a href="/display/NBR/nbrsf+-+API+Integration+Test">'
+                    'API Integration Test</a>')
+        self.assertEqual(convert_links(text, 'NBR', 'nbrsf'), expected)
+
+    def test_other_project(self):
+        """Should link [[project:Page]] to the page in the project's space"""
+        text = '[[nbrsf:api_integration_test|Tests]]'
+        expected = '<a href="/display/NBR/nbrsf+-+API+Integration+Test">Tests</a>'
+        self.assertEqual(convert_links(text, 'SPZ', 'other'), expected)
+
+    def test_titleized(self):
+        """Should find a page linked to as redmine would"""
+        LINK_INDEX.add('nbrsf', 'Release_12', 'NBR', 'nbrsf_-_Release_12')
+        text = '[[release 1.2]] [[Release, 1.2?]]'
+        expected = ('<a href="/display/NBR/nbrsf+-+Release+12">release 1.2</a> '
+                    '<a href="/display/NBR/nbrsf+-+Release+12">Release, 1.2?</a>')
+        self.assertEqual(convert_links(text, 'NBR', 'nbrsf'), expected)
+
+    def test_titleized_fallback(self):
+        """Should link to the title redmine gives a page not in the index"""
+        text = '[[setup; part 1.2]]'
+        expected = '<a href="/display/NBR/Setup+part+12">setup; part 1.2</a>'
+        self.assertEqual(convert_links(text, 'NBR', 'nbrsf'), expected)
+
+    def test_redmine_url(self):
+        """Should re-write a redmine url to the page's Confluence title"""
+        text = 'http://redmine/redmine/projects/nbrsf/wiki/API_Integration_Test'
+        url = '%s/display/NBR/nbrsf+-+API+Integration+Test' % CONFLUENCE['url']
+        self.assertEqual(convert_links(text, 'SPZ', 'other'),
+                         '<a href="%s">%s</a>' % (url, url))
+
+
+class TestXMLFixer(unittest.TestCase):
+    def fix(self, html):
+        return XMLFixer().fix_tags(html)
+
+    def test_balanced_html_untouched(self):
+        """Should leave well-formed html alone"""
+        html = '<p>Some <strong>text</strong><br /></p>\n<!-- comment -->'
+        self.assertEqual(self.fix(html), html)
+
+    def test_unclosed_tag_escaped(self):
+        """Should escape tags which are never closed"""
+        html = '<p>Include <stdio.h> here</p>'
+        expected = '<p>Include &lt;stdio.h&gt; here</p>'
+        self.assertEqual(self.fix(html), expected)
+
+    def test_unclosed_tag_with_attributes_escaped(self):
+        """Should escape text which looks like a tag with attributes"""
+        html = '<p>a <something like this> b</p>'
+        expected = '<p>a &lt;something like this&gt; b</p>'
+        self.assertEqual(self.fix(html), expected)
+
+    def test_only_unclosed_occurrence_escaped(self):
+        """Should only escape the occurrence of a tag which isn't closed"""
+        html = '<p><b>bold</b> <b>unclosed</p>'
+        expected = '<p><b>bold</b> &lt;b&gt;unclosed</p>'
+        self.assertEqual(self.fix(html), expected)
+
+    def test_stray_closing_tag_escaped(self):
+        """Should escape closing tags without an opening tag"""
+        html = '</div><p>text</p>'
+        expected = '&lt;/div&gt;<p>text</p>'
+        self.assertEqual(self.fix(html), expected)
+
+    def test_void_tags_closed(self):
+        """Should self-close void elements and quote attributes"""
+        html = '<p>x<br>y<img src=a.png></p>'
+        expected = '<p>x<br />y<img src="a.png" /></p>'
+        self.assertEqual(self.fix(html), expected)
+
+    def test_bare_ampersand_and_angle_bracket_escaped(self):
+        """Should escape bare & and < but leave entities alone"""
+        html = '<p>a & b &amp; c &nbsp; 1 < 2</p>'
+        expected = '<p>a &amp; b &amp; c &nbsp; 1 &lt; 2</p>'
+        self.assertEqual(self.fix(html), expected)
+
+    def test_not_entities_escaped(self):
+        """Should escape "&"s which look like, but aren't, entities"""
+        html = '<p>&1; &bogus; &#233; &#xE9; &eacute;</p>'
+        expected = '<p>&amp;1; &amp;bogus; &#233; &#xE9; &eacute;</p>'
+        self.assertEqual(self.fix(html), expected)
+
+    def test_attribute_ampersand_escaped(self):
+        """Should escape bare & in attribute values, quoted or not"""
+        html = ('<a href="http://x/?a=1&b=2&amp;c=3">x</a>'
+                '<a href=http://x/?a=1&b=2>y</a>')
+        expected = ('<a href="http://x/?a=1&amp;b=2&amp;c=3">x</a>'
+                    '<a href="http://x/?a=1&amp;b=2">y</a>')
+        self.assertEqual(self.fix(html), expected)
+
+    def test_query_string_link_well_formed(self):
+        """Should not take the nuclear option for a link with a query string"""
+        source = convert_links(u'see http://jira/browse?a=1&b=2', 'SPZ')
+        converted = r2c.convert_page(source, u'T')
+        self.assertFalse(converted['nuclear'])
+        self.assertIn(u'href="http://jira/browse?a=1&amp;b=2"',
+                      converted['body'])
+
+    def test_attachment_images_rewritten(self):
+        """Should turn images of attachments into attachment references"""
+        fixer = XMLFixer({u'a b.png': 'a+b.png'})
+        html = u'<p><img src="a%20b.png" alt=x><img src="http://x/a.png"></p>'
+        expected = (u'<p><ac:image><ri:attachment ri:filename="a+b.png" />'
+                    u'</ac:image><img src="http://x/a.png" /></p>')
+        self.assertEqual(fixer.fix_tags(html), expected)
+
+
+class TestTextileConversion(unittest.TestCase):
+    def test_table_pandoc_cannot_parse(self):
+        """Should convert tables pandoc leaves as paragraphs with textile"""
+        html = convert_textile(u'| a |\n| b | c |\nnot a row\n| d |')
+        self.assertIn(u'<td> d </td>', html)
+        self.assertNotIn(u'<p>|', html)
+
+    def test_pipe_paragraph_kept(self):
+        """Should keep a paragraph starting with "|" which isn't a table"""
+        self.assertIn(u'<p>|a|b|<br />\n|c</p>', convert_textile(u'|a|b|\n|c'))
+
+
+class TestPandocBatching(unittest.TestCase):
+    bodies = [
+        u'Text[1]\n\nfn1. The note',
+        u'h1. Intro\n\ntext',
+        u'h1. Intro\n\nmore text',
+        u'bc.. code\n\nmore code',
+        u'',
+        u'after *the* code',
+        u'h2. Setup\n\n# one\n# two'
+    ]
+
+    def setUp(self):
+        self.calls = []
+        self.textile_to_html = converter.textile_to_html
+
+        def counted(body):
+            self.calls.append(body)
+            return self.textile_to_html(body)
+        converter.textile_to_html = counted
+
+    def tearDown(self):
+        converter.textile_to_html = self.textile_to_html
+
+    def test_same_as_single(self):
+        """Should convert each body as if it were converted on its own"""
+        single = [self.textile_to_html(body) for body in self.bodies]
+        self.assertEqual(converter.textile_to_html_many(self.bodies), single)
+
+    def test_batched(self):
+        """Should only convert bodies on their own where they need it"""
+        converter.textile_to_html_many(self.bodies)
+        # the batch, the footnote, the duplicate heading and the empty body
+        self.assertEqual(len(self.calls), 4)
+
+    def test_numbered_headings_batched(self):
+        """Should batch bodies whose headings merely end in a number"""
+        bodies = [u'h2. Part 1\n\ntext', u'h2. Release 2\n\ntext',
+                  u'h2. Part 1\n\nagain']
+        htmls = converter.textile_to_html_many(bodies)
+        self.assertEqual(htmls, [self.textile_to_html(body) for body in bodies])
+        # the batch and the repeated heading
+        self.assertEqual(len(self.calls), 2)
+
+    def test_batcher(self):
+        """Should convert bodies submitted by several threads"""
+        batcher = converter.PandocBatcher()
+        pool = ThreadPool(len(self.bodies))
+        try:
+            htmls = pool.map(batcher.convert, self.bodies)
+        finally:
+            pool.close()
+            batcher.stop()
+        self.assertEqual(htmls, [self.textile_to_html(body)
+                                 for body in self.bodies])
+        self.assertFalse(batcher.thread)
+
+
+class FakeWikiPage(object):
+    def __init__(self, title, parent=None):
+        self.title = title
+        self._parent = parent
+
+    @property
+    def parent(self):
+        if self._parent is None:
+            raise ResourceAttrError()
+        return {'title': self._parent}
+
+
+class TestHierarchyOrder(unittest.TestCase):
+    def titles(self, wiki_pages):
+        return [wiki_page.title for wiki_page in hierarchy_order(wiki_pages)]
+
+    def test_parents_before_children(self):
+        """Should order every page after its parent"""
+        wiki_pages = [FakeWikiPage('Grandchild', 'Child'),
+                      FakeWikiPage('Child', 'Wiki'),
+                      FakeWikiPage('Other', 'Wiki'),
+                      FakeWikiPage('Wiki')]
+        self.assertEqual(self.titles(wiki_pages),
+                         ['Wiki', 'Child', 'Other', 'Grandchild'])
+
+    def test_missing_parent(self):
+        """Should treat pages whose parent doesn't exist as top level pages"""
+        wiki_pages = [FakeWikiPage('Child', 'Missing'), FakeWikiPage('Wiki')]
+        self.assertEqual(self.titles(wiki_pages), ['Child', 'Wiki'])
+
+    def test_parent_loop(self):
+        """Should not lose pages whose parents form a loop"""
+        wiki_pages = [FakeWikiPage('A', 'B'), FakeWikiPage('B', 'A')]
+        self.assertEqual(sorted(self.titles(wiki_pages)), ['A', 'B'])
+
+
+class TestBundle(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def meta(self, title, parent=None, nuclear=False):
+        return {
+            'title': title, 'parent': parent, 'version': 2,
+            'updated_on': '2016-01-01 00:00:00', 'username': 'u',
+            'display_name': 'U', 'images': {u'a.png': u'a.png'},
+            'nuclear': nuclear,
+            'attachments': [{'id': 1, 'filename': 'a.png', 'filesize': 4,
+                             'description': '', 'content_url': '',
+                             'digest': None}]}
+
+    def test_round_trip(self):
+        """Should read back the pages written to a bundle"""
+        writer = BundleWriter(self.path, 'proj', 'SPC', 'Project', 'About')
+        writer.add_page(self.meta('Wiki'), u'<p>caf\xe9</p>', u'caf\xe9')
+        writer.add_page(self.meta('Child', 'Wiki', nuclear=True),
+                        u'<p>child</p>', u'child')
+        writer.close()
+
+        projects = read_bundle(self.path)
+        self.assertEqual(len(projects), 1)
+        project = projects[0]
+        self.assertEqual(
+            (project['project'], project['space'], project['name'],
+             project['description']), ('proj', 'SPC', 'Project', 'About'))
+        wiki, child = project['pages']
+        self.assertEqual(wiki.title, 'Wiki')
+        self.assertRaises(ResourceAttrError, lambda: wiki.parent)
+        self.assertEqual(child.parent, {'title': 'Wiki'})
+        self.assertEqual(child.version, 2)
+        self.assertEqual(child.attachments[0].filename, 'a.png')
+        self.assertIsNone(wiki.converted)
+        self.assertEqual(wiki.load().converted, {
+            'body': u'<p>caf\xe9</p>', 'source': u'caf\xe9',
+            'nuclear': False})
+        self.assertEqual(child.load().converted, {
+            'body': u'<p>child</p>', 'source': u'child', 'nuclear': True})
+
+
+class TestRenamePage(unittest.TestCase):
+    def setUp(self):
+        r2c.init_stats('proj')
+
+    def test_prefixed(self):
+        """Should prefix the title with the project name"""
+        titles = TitleIndex(['Page'])
+        self.assertEqual(r2c.rename_page(FakeWikiPage('Page'), 'proj', titles),
+                         'proj_-_Page')
+        self.assertFalse(titles.claim('proj - Page'))
+
+    def test_prefixed_taken(self):
+        """Should add a further suffix if the prefixed title is taken too"""
+        titles = TitleIndex(['Page', 'proj - Page', 'proj - Page (2)'])
+        self.assertEqual(r2c.rename_page(FakeWikiPage('Page'), 'proj', titles),
+                         'proj_-_Page_(3)')
+        self.assertEqual(r2c.STATS['proj']['renamed'], {'Page': 'proj_-_Page_(3)'})
+
+
+class FakeConfluence(object):
+    """Records the calls the importer makes"""
+    def __init__(self):
+        self.calls = []
+
+    def create_page(self, title, body, space, username, display_name,
+                    parent_id=None):
+        self.calls.append(('create_page', title))
+        return {'id': '100'}
+
+    def update_page(self, page_id, content):
+        self.calls.append(('update_page', page_id))
+
+    def add_attachment(self, confluence_id, filename, data, description):
+        self.calls.append(('add_attachment', confluence_id, filename))
+        return {'results': [{'title': filename}]}
+
+
+class TestResumeAndSync(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        # set up by __main__ otherwise
+        self.saved = dict((name, getattr(r2c, name, None)) for name in
+                          ['journal', 'confluence', 'ATTACHMENT_CACHE'])
+        r2c.journal = Journal(os.path.join(self.path, 'journal.sqlite'))
+        r2c.confluence = FakeConfluence()
+        r2c.ATTACHMENT_CACHE = AttachmentCache(
+            os.path.join(self.path, 'attachments'), 1024 * 1024)
+        for attachment_id in [1, 2]:
+            r2c.ATTACHMENT_CACHE.put(attachment_id, ['data']).close()
+        r2c.init_stats('proj')
+
+    def tearDown(self):
+        for name, value in self.saved.iteritems():
+            setattr(r2c, name, value)
+        shutil.rmtree(self.path)
+
+    def wiki_page(self, version=1, updated_on='2016-01-01 00:00:00'):
+        attachments = [
+            {'id': attachment_id, 'filename': 'a%d.txt' % attachment_id,
+             'filesize': 4, 'description': '', 'content_url': '',
+             'digest': None}
+            for attachment_id in [1, 2]]
+        page = ExportedPage(self.path, {
+            'title': 'Page', 'parent': None, 'version': version,
+            'updated_on': updated_on, 'attachments': attachments,
+            'images': [], 'username': 'u', 'display_name': 'U',
+            'nuclear': False})
+        page.converted = {'body': '<p>text</p>', 'source': 'text',
+                          'nuclear': False}
+        return page
+
+    def import_page(self, wiki_page, sync=False):
+        created_pages = r2c.CreatedPages([wiki_page])
+        r2c.import_page(wiki_page, 'proj', 'SPC', created_pages,
+                        TitleIndex([]), sync=sync)
+        return created_pages
+
+    def test_import(self):
+        """Should record the created page and its attachments"""
+        self.import_page(self.wiki_page())
+        self.assertEqual(r2c.confluence.calls, [
+            ('create_page', 'Page'),
+            ('add_attachment', '100', 'a1.txt'),
+            ('add_attachment', '100', 'a2.txt')])
+        entry = r2c.journal.get_page('proj', 'Page')
+        self.assertEqual(entry['status'], 'complete')
+        self.assertEqual(entry['confluence_id'], '100')
+        self.assertEqual(r2c.journal.attachments_added('proj', 'Page'),
+                         set([1, 2]))
+
+    def test_skip_complete(self):
+        """Should skip a completed page, but know where it is"""
+        r2c.journal.page_created('proj', 'Page', 'Page', '7', None, 1,
+                                 '2016-01-01 00:00:00')
+        r2c.journal.set_status('proj', 'Page', 'complete')
+        created_pages = self.import_page(self.wiki_page())
+        self.assertEqual(r2c.confluence.calls, [])
+        self.assertEqual(created_pages.get('Page', 'Page'),
+                         {'id': '7', 'title': 'Page'})
+
+    def test_resume_partial(self):
+        """Should reuse a partly imported page and only add what's missing"""
+        r2c.journal.page_created('proj', 'Page', 'Page', '7', None, 1,
+                                 '2016-01-01 00:00:00')
+        r2c.journal.attachment_added('proj', 'Page', 1, 'a1.txt')
+        self.import_page(self.wiki_page())
+        self.assertEqual(r2c.confluence.calls,
+                         [('add_attachment', '7', 'a2.txt')])
+        self.assertEqual(r2c.journal.get_page('proj', 'Page')['status'],
+                         'complete')
+
+    def complete(self):
+        r2c.journal.page_created('proj', 'Page', 'Page', '7', None, 1,
+                                 '2016-01-01 00:00:00')
+        for attachment_id in [1, 2]:
+            r2c.journal.attachment_added('proj', 'Page', attachment_id, '')
+        r2c.journal.set_status('proj', 'Page', 'complete')
+
+    def test_sync_unchanged(self):
+        """Should leave a page alone which hasn't changed"""
+        self.complete()
+        self.import_page(self.wiki_page(), sync=True)
+        self.assertEqual(r2c.confluence.calls, [])
+        self.assertEqual(r2c.STATS['proj']['updated'], [])
+
+    def test_sync_new_version(self):
+        """Should rewrite a page with a new version"""
+        self.complete()
+        self.import_page(self.wiki_page(version=2), sync=True)
+        self.assertEqual(r2c.confluence.calls, [('update_page', '7')])
+        self.assertEqual(r2c.journal.get_page('proj', 'Page')['version'], 2)
+        self.assertEqual(r2c.STATS['proj']['updated'], ['Page'])
+
+    def test_sync_updated_on(self):
+        """Should rewrite a page updated without a new version"""
+        self.complete()
+        self.import_page(self.wiki_page(updated_on='2016-02-01 00:00:00'),
+                         sync=True)
+        self.assertEqual(r2c.confluence.calls, [('update_page', '7')])
+
+    def test_sync_new_attachment(self):
+        """Should only upload attachments added since the last run"""
+        self.complete()
+        r2c.journal._execute('DELETE FROM attachments WHERE attachment_id = 2')
+        self.import_page(self.wiki_page(), sync=True)
+        self.assertEqual(r2c.confluence.calls,
+                         [('add_attachment', '7', 'a2.txt')])
+        self.assertEqual(r2c.STATS['proj']['updated'], ['Page'])
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_throttled_response_halves_rate(self):
+        """Should slow down by half, for as long as the server asks"""
+        limiter = RateLimiter(10)
+        with self.assertRaises(Throttled):
+            limiter.observe(FakeResponse(429, {'Retry-After': '0'}))
+        self.assertEqual(limiter.rate, 5)
+        self.assertEqual(limiter.stats()['throttled'], 1)
+
+    def test_success_speeds_up_to_rate(self):
+        """Should speed up again on success, but not beyond the rate"""
+        limiter = RateLimiter(10)
+        limiter.throttle('timeouts', wait=0)
+        for _ in range(100):
+            limiter.observe(FakeResponse(200))
+        self.assertEqual(limiter.rate, 10)
+
+    def test_rate_must_be_positive(self):
+        """Should refuse a rate at which no request could be made"""
+        with self.assertRaises(ValueError):
+            RateLimiter(0)
+
+    def test_call_retries_throttled(self):
+        """Should retry a throttled request"""
+        limiter = RateLimiter(100)
+        responses = [FakeResponse(503, {'Retry-After': '0'}), FakeResponse(200)]
+        res = limiter.call(lambda: limiter.observe(responses.pop(0)))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(limiter.stats()['requests'], 2)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_report_per_project_and_total(self):
+        """Should count a stage both in its project and in the total"""
+        metrics = Metrics()
+        with metrics.project('proj'):
+            metrics.record('convert_textile', 0.2, 100)
+        metrics.record('convert_textile', 20, 50)
+        report = metrics.report()
+        self.assertEqual(report['proj']['convert_textile']['count'], 1)
+        self.assertEqual(report['total']['convert_textile']['bytes'], 150)
+        histogram = report['total']['convert_textile']['histogram']
+        self.assertEqual(histogram['0.1'], 0)
+        self.assertEqual(histogram['0.5'], 1)
+        self.assertEqual(histogram['+Inf'], 2)
+
+    def test_prometheus(self):
+        """Should write histograms in the Prometheus text format"""
+        metrics = Metrics()
+        metrics.record('create_page', 0.2, 100)
+        text = metrics.prometheus({'rate limiter requests': 3})
+        self.assertIn('redmine2confluence_stage_seconds_bucket'
+                      '{project="total",stage="create_page",le="0.5"} 1', text)
+        self.assertIn('redmine2confluence_rate_limiter_requests 3', text)
+
+
+class TestBenchmarkCorpus(unittest.TestCase):
+    def test_parents_exist(self):
+        """Should only generate pages whose parents are in the same project"""
+        corpus = generate_corpus(pages=40)
+        for project in corpus.values():
+            titles = set(page['title'] for page in project['wiki_pages'])
+            for page in project['wiki_pages']:
+                self.assertTrue(page['parent'] is None or page['parent'] in titles)
+
+
+class TestPreconverter(unittest.TestCase):
+    def setUp(self):
+        self.preconverter = r2c.Preconverter()
+        self.calls = []
+        self.textile_to_html = converter.textile_to_html
+
+        def counted(body):
+            self.calls.append(body)
+            return self.textile_to_html(body)
+        converter.textile_to_html = counted
+
+    def tearDown(self):
+        self.preconverter.stop()
+        converter.textile_to_html = self.textile_to_html
+
+    def wiki_pages(self, count):
+        wiki_pages = []
+        for idx in range(count):
+            wiki_page = FakeWikiPage('Page_%d' % idx)
+            wiki_page.text = u'h2. Part %s\n\n*text* of [[Other]]' % chr(65 + idx)
+            wiki_pages.append(wiki_page)
+        return wiki_pages
+
+    def test_same_as_convert_text(self):
+        """Should convert submitted pages in batches, as convert_text would"""
+        wiki_pages = self.wiki_pages(8)
+        for wiki_page in wiki_pages:
+            self.preconverter.submit(wiki_page, 'proj', 'SPC', wiki_page.title)
+        converted = [self.preconverter.take(wiki_page, 'proj', 'SPC',
+                                            wiki_page.title)
+                     for wiki_page in wiki_pages]
+        # one pandoc invocation per batch
+        self.assertLess(len(self.calls), len(wiki_pages) / 2)
+        self.assertEqual(converted, [
+            r2c.convert_text(wiki_page, 'proj', 'SPC', wiki_page.title)
+            for wiki_page in wiki_pages])
+
+    def test_batches(self):
+        """Should limit the source of a batch, converting large pages alone"""
+        preconverter = r2c.Preconverter(batch_chars=10)
+        jobs = [{'source': 'x' * size} for size in [4, 4, 4, 20, 4]]
+        self.assertEqual(
+            [[len(job['source']) for job in batch]
+             for batch in preconverter.batches(jobs)],
+            [[4, 4], [4], [20], [4]])
+
+    def test_other_title(self):
+        """Should not give a page converted under another title"""
+        wiki_page = self.wiki_pages(1)[0]
+        self.preconverter.submit(wiki_page, 'proj', 'SPC', 'Title')
+        self.assertIsNone(self.preconverter.take(
+            wiki_page, 'proj', 'SPC', 'proj - Title'))
+
+    def test_error(self):
+        """Should raise an error converting the page when it's taken"""
+        wiki_page = FakeWikiPage('Page')
+        self.preconverter.submit(wiki_page, 'proj', 'SPC', 'Page')
+        with self.assertRaises(AttributeError):
+            self.preconverter.take(wiki_page, 'proj', 'SPC', 'Page')
+
+
+class TestConversionPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = ConversionPool(1, timeout=1, memory_limit=256 * 1024 * 1024)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_convert(self):
+        """Should return the result of the worker"""
+        self.assertEqual(self.pool.convert(len, 'abc'), 3)
+
+    def test_timeout(self):
+        """Should give up on a conversion taking too long, and carry on"""
+        with self.assertRaises(ConversionFailed):
+            self.pool.convert(time.sleep, 5)
+        self.assertEqual(self.pool.convert(len, 'abc'), 3)
+
+    def test_longer_timeout(self):
+        """Should allow a call its own timeout"""
+        self.assertIsNone(self.pool.convert(time.sleep, 1.5, timeout=3))
+        with self.assertRaises(ConversionFailed):
+            self.pool.convert(time.sleep, 5, timeout=0.5)
+
+    def test_memory_limit(self):
+        """Should give up on a conversion using too much memory"""
+        with self.assertRaises(ConversionFailed):
+            self.pool.convert(bytearray, 512 * 1024 * 1024)
+
+    def test_error(self):
+        """Should raise other errors, keeping the worker"""
+        with self.assertRaises(RuntimeError):
+            self.pool.convert(int, 'abc')
+        self.assertEqual(self.pool.convert(len, 'abc'), 3)
+
+
+class TestMultipartBody(unittest.TestCase):
+    def test_body(self):
+        """Should stream the exact multipart body, again after a rewind"""
+        body = MultipartBody({'comment': u'caf\xe9'}, 'a.txt', io.BytesIO('data'))
+        boundary = body.content_type.split('boundary=')[1]
+        expected = (
+            '--%s\r\nContent-Disposition: form-data; name="comment"\r\n\r\n'
+            'caf\xc3\xa9\r\n'
+            '--%s\r\nContent-Disposition: form-data; name="file"; '
+            'filename="a.txt"\r\nContent-Type: application/octet-stream\r\n\r\n'
+            'data\r\n--%s--\r\n' % (boundary, boundary, boundary))
+        self.assertEqual(len(body), len(expected))
+        chunks = []
+        while True:
+            chunk = body.read(7)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.assertEqual(''.join(chunks), expected)
+        self.assertEqual(body.tell(), len(expected))
+        body.seek(0)
+        self.assertEqual(body.read(), expected)
+
+
+class FakeJsonResponse(FakeResponse):
+    def __init__(self, data, status_code=200):
+        FakeResponse.__init__(self, status_code)
+        self.data = data
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        pass
+
+
+class TestGetTitles(unittest.TestCase):
+    def get_titles(self, responses):
+        client = Confluence('http://confluence', 'u', 'p')
+        self.starts = []
+
+        def request(method, url, **kwargs):
+            self.starts.append(kwargs['params']['start'])
+            return FakeJsonResponse(responses.pop(0))
+        client._request = request
+        return client.get_titles('SPC')
+
+    def test_pages_smaller_than_limit(self):
+        """Should follow "next" links when the server caps the page size"""
+        titles = self.get_titles([
+            {'results': [{'title': 'A'}, {'title': 'B'}], 'limit': 2,
+             'size': 2, '_links': {'next': '/rest/api/content?start=2'}},
+            {'results': [{'title': 'C'}], 'limit': 2, 'size': 1,
+             '_links': {}}])
+        self.assertEqual(titles, ['A', 'B', 'C'])
+        self.assertEqual(self.starts, [0, 2])
+
+    def test_full_page_without_links(self):
+        """Should stop on an empty page if the server gives no links"""
+        titles = self.get_titles([
+            {'results': [{'title': 'A'}, {'title': 'B'}], 'limit': 2},
+            {'results': [], 'limit': 2}])
+        self.assertEqual(titles, ['A', 'B'])
+
+
+class TestAttachmentCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def read(self, data):
+        if data is None:
+            return None
+        with data:
+            return data.read()
+
+    def test_identical_content_stored_once(self):
+        """Should store attachments with the same content once"""
+        cache = AttachmentCache(self.path, 1024)
+        self.read(cache.put(1, ['same ', 'data']))
+        self.read(cache.put(2, ['same data']))
+        self.assertEqual(self.read(cache.get(1)), 'same data')
+        self.assertEqual(self.read(cache.get(2)), 'same data')
+        self.assertEqual(len(cache._execute('SELECT * FROM blobs')), 1)
+
+    def test_lookup_by_checksum(self):
+        """Should find the content of another attachment by its checksum"""
+        cache = AttachmentCache(self.path, 1024)
+        self.read(cache.put(1, ['data'], checksum='abc'))
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(self.read(cache.get(2, 'abc')), 'data')
+        # remembered under the new id too
+        self.assertEqual(self.read(cache.get(2)), 'data')
+
+    def test_least_recently_used_evicted(self):
+        """Should evict the least recently used files, and forget them"""
+        cache = AttachmentCache(self.path, 10)
+        self.read(cache.put(1, ['1111'], checksum='one'))
+        time.sleep(0.01)
+        self.read(cache.put(2, ['2222'], checksum='two'))
+        time.sleep(0.01)
+        self.read(cache.get(1))
+        time.sleep(0.01)
+        self.read(cache.put(3, ['3333']))
+        self.assertIsNone(cache.get(2))
+        self.assertIsNone(cache.get(4, 'two'))
+        self.assertEqual(self.read(cache.get(1)), '1111')
+        self.assertEqual(self.read(cache.get(3)), '3333')
+        for table in ['blobs', 'attachments', 'checksums']:
+            self.assertEqual(cache._execute(
+                'SELECT COUNT(*) FROM %s WHERE digest NOT IN '
+                '(SELECT digest FROM blobs)' % table), [(0,)])
+        self.assertEqual(len(cache._execute('SELECT * FROM attachments')), 2)
+
+    def test_failed_download_removed(self):
+        """Should remove the partial file if the download fails"""
+        cache = AttachmentCache(self.path, 1024)
+        files = os.listdir(self.path)
+
+        def chunks():
+            yield 'partial'
+            raise IOError('connection reset')
+        self.assertRaises(IOError, cache.put, 1, chunks())
+        self.assertEqual(os.listdir(self.path), files)
+        self.assertIsNone(cache.get(1))
+
+    def test_most_recent_kept(self):
+        """Should keep the most recently used file even if it's too big"""
+        cache = AttachmentCache(self.path, 4)
+        self.read(cache.put(1, ['1111']))
+        time.sleep(0.01)
+        self.read(cache.put(2, ['too big']))
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(self.read(cache.get(2)), 'too big')
+
+
+class TestConversionCache(unittest.TestCase):
+    body = u'h2. Setup\n\n*text* with !image.png!'
+    images = {u'image.png': u'image.png'}
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.saved = dict((name, getattr(r2c, name)) for name in
+                          ['CONVERSION_CACHE', 'CONVERTER_VERSION'])
+        r2c.CONVERSION_CACHE = ConversionCache(
+            os.path.join(self.path, 'conversions.sqlite'))
+        self.calls = []
+        self.textile_to_html = converter.textile_to_html
+
+        def counted(body):
+            self.calls.append(body)
+            return self.textile_to_html(body)
+        converter.textile_to_html = counted
+
+    def tearDown(self):
+        converter.textile_to_html = self.textile_to_html
+        for name, value in self.saved.iteritems():
+            setattr(r2c, name, value)
+        shutil.rmtree(self.path)
+
+    def test_hit(self):
+        """Should not convert a body again once it's cached"""
+        html = r2c.convert_body(self.body, 'Page', images=self.images)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(
+            r2c.convert_body(self.body, 'Page', images=self.images), html)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_converter_version(self):
+        """Should convert the body again after the converter changed"""
+        r2c.convert_body(self.body, 'Page')
+        r2c.CONVERTER_VERSION += 1
+        r2c.convert_body(self.body, 'Page')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_arguments(self):
+        """Should convert the body again for another title, nuclear flag or
+        images
+        """
+        r2c.convert_body(self.body, 'Page')
+        r2c.convert_body(self.body, 'Other')
+        r2c.convert_body(self.body, 'Page', nuclear=True)
+        r2c.convert_body(self.body, 'Page', images=self.images)
+        self.assertEqual(len(self.calls), 4)